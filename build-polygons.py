@@ -4,79 +4,146 @@ import re
 import sys
 import psycopg2
 import os
-
-from shapely.geometry import Point
-from shapely.ops import cascaded_union
+import numpy
 
 from habitats import *
 from config import *
 
+polygon_magic = 'HABPOLY1'
+polygon_re = re.compile(r'^polygon (\d+) \(type = (\d+)\) \(points = (\d+)\):\s*(.*?)\s*$')
 max_points = 500000
 point_buffer = 10.0 # m
 initial_simplify = 10.0 # m
 n_workers = os.sysconf(os.sysconf_names['SC_NPROCESSORS_ONLN'])
 
-def build_polygon(n_points, points):
-    geom = []
-    for p_str in points.split(' '):
-        if len(p_str) > 1:
-            (x, y) = p_str.lstrip().split(',')
-            p = Point(int(x), int(y))
-            geom.append(p.buffer(point_buffer))
-    assert(len(geom) == n_points)
+def build_polygon(n_points, xs, ys):
+    assert(len(xs) == n_points)
 
-    polygon = cascaded_union(geom)
+    polygon = trace_polygon(xs.astype(numpy.float64), ys.astype(numpy.float64), step, point_buffer)
     if polygon.is_valid and polygon.geom_type == 'Polygon':
         return polygon.simplify(initial_simplify)
     else:
         print 'invalid polygon generated'
         sys.exit(1)
 
-def process_polygons(label, queue, polygons):
+def read_polygon_text(path):
+    # the text route writes to stdout without an output file, one polygon
+    # per line, read into the layout of the binary stream
+    records = [numpy.fromstring(polygon_magic, dtype='<i4'), numpy.array([step], dtype='<i4')]
+    fh = open(path, 'r')
+    for line in fh:
+        m = polygon_re.match(line)
+        if m:
+            records.append(numpy.array(map(int, m.group(1, 2, 3)), dtype='<i4'))
+            records.append(numpy.fromstring(m.group(4).replace(',', ' '), dtype='<i4', sep=' '))
+    fh.close()
+    return numpy.concatenate(records)
+
+def open_polygons(path):
+    # the binary stream written by route: magic and step, then per polygon
+    # id, type and count followed by count x, y pairs, all int32; anything
+    # else is taken to be route's text output
+    fh = open(path, 'rb')
+    magic = fh.read(len(polygon_magic))
+    fh.close()
+    if magic == polygon_magic:
+        data = numpy.memmap(path, dtype='<i4', mode='r')
+    else:
+        data = read_polygon_text(path)
+    if len(data) <= 3:
+        print path, 'holds no polygons'
+        sys.exit(1)
+    return data
+
+def polygon_index(data):
+    # walk the record headers into arrays of id, type, count and offset
+    # without touching the points themselves
+    index = ([], [], [], [])
+    p = 3
+    while p < len(data):
+        (polygon_id, polygon_type, n_points) = data[p:p + 3].tolist()
+        for (column, v) in zip(index, (polygon_id, polygon_type, n_points, p + 3)):
+            column.append(v)
+        p += 3 + (n_points * 2)
+    return [numpy.array(column, dtype=numpy.int64) for column in index]
+
+def largest_first(ids, types, counts, where):
+    # records by decreasing point count; only the headers are sorted, the
+    # points are read by the workers as each record is handed out
+    for k in numpy.argsort(-counts, kind='mergesort'):
+        yield (int(ids[k]), int(types[k]), int(counts[k]), where[k])
+
+def stream_points(n_points, offset):
+    points = polygon_data[offset:offset + (n_points * 2)]
+    return (points[0::2], points[1::2])
+
+def open_labels(path):
+    # the label raster written by label-grid and its component list
+    labels = numpy.load(path, mmap_mode='r')
+    fh = open(path[:-len('.npy')] + '.txt', 'r')
+    header = fh.readline().split()
+    grid = dict(zip(header[0::2], map(int, header[1::2])))
+    components = []
+    for line in fh:
+        (c_id, c_type, c_count, c_min_x, c_min_y, c_max_x, c_max_y) = map(int, line.split())
+        # bounding box back in grid cells
+        bbox = tuple([(v / grid['step']) - b for (v, b) in
+            zip((c_min_x, c_min_y, c_max_x, c_max_y), (grid['base_x'], grid['base_y']) * 2)])
+        components.append((c_id, c_type, c_count, bbox))
+    fh.close()
+    if not components:
+        print path, 'holds no components'
+        sys.exit(1)
+    return (labels, grid, components)
+
+def label_points(polygon_id, bbox):
+    # the cells of a component, read from its window of the label raster
+    (min_x, min_y, max_x, max_y) = bbox
+    (ys, xs) = numpy.nonzero(polygon_data[min_y:max_y + 1, min_x:max_x + 1] == polygon_id)
+    xs = (xs + min_x + label_grid['base_x']) * label_grid['step']
+    ys = (ys + min_y + label_grid['base_y']) * label_grid['step']
+    return (xs, ys)
+
+def process_polygons(label, results, polygons):
     conn = psycopg2.connect("dbname=gis")
     cur = conn.cursor()
 
-    try:
-        skipped = 0
-        for (polygon_id, polygon_type, n_points, points) in polygons:
-            if n_points <= max_points:
-                print label, polygon_id, polygon_type, n_points
-                polygon = build_polygon(n_points, points)
-                print label, polygon_id, len(str(polygon))
-                cur.execute("INSERT INTO habitat_raw (polygon_id, h_type, geom) VALUES(%s,%s,ST_Transform(ST_SetSRID(ST_GeomFromText(%s),27700),4326));",
-                    (polygon_id, polygon_type, str(polygon)))
-                conn.commit()
+    skipped = 0
+    for (polygon_id, polygon_type, n_points, where) in polygons:
+        if n_points <= max_points:
+            print label, polygon_id, polygon_type, n_points
+            if label_grid:
+                (xs, ys) = label_points(polygon_id, where)
             else:
-                skipped += 1
-            if not queue.empty():
-                return
-        print label, "skipped =", skipped
-    except KeyboardInterrupt:
-        pass
+                (xs, ys) = stream_points(n_points, where)
+            polygon = build_polygon(n_points, xs, ys)
+            print label, polygon_id, polygon_vertices(polygon)
+            insert_habitat(cur, 'habitat_raw', polygon_id, polygon_type, polygon)
+            conn.commit()
+        else:
+            skipped += 1
+    print label, "skipped =", skipped
 
     conn.commit()
     conn.close()
-    queue.close()
 
 if len(sys.argv) < 2:
-    print "build-polygons <input-file>"
+    print "build-polygons <polygons-file | labels.npy>"
     sys.exit(1)
 
 source = sys.argv[1]
 
-polygon_re = re.compile(r'^polygon (\d+) \(type = (\d+)\) \(points = (\d+)\):\s*(.*?)\s*$')
+# mapped before the workers start so they share it; each worker reads only
+# the points of the polygons it is handed, largest first so none is left
+# running on its own at the end
+label_grid = None
+if source.endswith('.npy'):
+    (polygon_data, label_grid, components) = open_labels(source)
+    (ids, types, counts, bboxes) = zip(*components)
+    work = largest_first(ids, types, numpy.array(counts), bboxes)
+else:
+    polygon_data = open_polygons(source)
+    (ids, types, counts, offsets) = polygon_index(polygon_data)
+    work = largest_first(ids, types, counts, offsets.tolist())
 
-data = []
-fh = open(source, 'r')
-for line in fh:
-    m = polygon_re.match(line)
-    if m:
-        polygon_id = int(m.group(1))
-        polygon_type = int(m.group(2))
-        n_points = int(m.group(3))
-        points = m.group(4)
-        data.append((polygon_id, polygon_type, n_points, points))
-        print 'loaded', polygon_id, n_points
-fh.close()
-
-do_process_par(data, n_workers, process_polygons)
+do_stream_par(work, n_workers, process_polygons)
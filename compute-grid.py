@@ -1,42 +1,40 @@
 #!/usr/bin/env python
 
 import subprocess
-import pyproj
 import psycopg2
+import numpy
 import math
 import time
 import threading
 import sys
 import os
 
+from shapely.geometry import Point, box
+from shapely.strtree import STRtree
+
 from habitats import *
 from config import *
 
 # globals
 shutdown = False
-etrs89 = pyproj.Proj(init='epsg:3035')
-osgb36 = pyproj.Proj(init='epsg:27700')
-wgs84 = pyproj.Proj(init='epsg:4326')
-output_type_map = None
-output_stats = None
-ref_index = None
-
-def dict_with_keys(keys, value=0):
-    d = {}
-    for k in keys:
-        d[k] = value
-    return d
-
-def dict_with_keys2(keys, value=0):
-    d = {}
-    for k in keys:
-        d[k] = dict_with_keys(keys, value=value)
-    return d
-
-def grid_points(x, y, width, height, step):
-    for xi in range(int(width / step)):
-        for yi in range(int(height / step)):
-            yield ((x + (xi * step)), (y + (yi * step)))
+output_confusion = None
+raster = None
+
+def grid_tiles(width, height, step, size):
+    # tiles are (xi, yi, n_x, n_y) in grid cells relative to min_x, min_y
+    n_x = int(width / step)
+    n_y = int(height / step)
+    n = max(int(size / step), 1)
+    for xi in range(0, n_x, n):
+        for yi in range(0, n_y, n):
+            yield (xi, yi, min(n, n_x - xi), min(n, n_y - yi))
+
+def tile_grid(tile):
+    # the points of a tile as arrays, walking each column in turn
+    (xi, yi, n_x, n_y) = tile
+    xs = min_x + (numpy.repeat(numpy.arange(xi, xi + n_x), n_y) * step)
+    ys = min_y + (numpy.tile(numpy.arange(yi, yi + n_y), n_x) * step)
+    return (xs, ys)
 
 def generate_points(x, y, width, height, step, mapper, queue):
     grid = []
@@ -47,151 +45,110 @@ def generate_points(x, y, width, height, step, mapper, queue):
             #print 'put', (this_x, this_y)
             queue.put(mapper((this_x, this_y)))
 
-def osgb36_to_wgs84(coord):
-    if not isinstance(coord, list):
-        (easting, northing) = coord
-        lon, lat = pyproj.transform(osgb36, wgs84, easting, northing)
-        return (lon, lat)
-    else:
-        r = []
-        for (easting, northing) in coord:
-            lon, lat = pyproj.transform(osgb36, wgs84, easting, northing)
-            r.append((lon, lat))
-        return r
-
-def osgb36_to_etrs89(coord):
-    if not isinstance(coord, list):
-        (easting, northing) = coord
-        e, n = pyproj.transform(osgb36, etrs89, easting, northing)
-        return (e, n)
-    else:
-        r = []
-        for (easting, northing) in coord:
-            e, n = pyproj.transform(osgb36, etrs89, easting, northing)
-            r.append((e, n))
-        return r
-
 def open_db():
     conn = psycopg2.connect("dbname=gis")
     cur = conn.cursor()
     return (conn, cur)
 
-def process_corine_points(label, coords):
-    global shutdown
-
-    commit_buffer = 1000
-    (conn, cur) = open_db()
-
-    found = 0
-    missing = 0
-    extra = 0
-    skipped = 0
-    pending = 0
-    n = 0
-
-    print label, 'start', time.time()
-
-    for (ref, easting, northing) in coords:
-        if shutdown:
-            print label, 'shutdown'
-            return
-
-        n += 1
-        cur.execute("SELECT ref, code FROM cell WHERE ref = %s", (ref,))
-        results = cur.fetchall()
-        code = None
-        _ref = None
-        if len(results) != 0:
-            (_ref, code) = results[0]
-        
-        if code is None:
-            cur.execute("SELECT code, name FROM clc_tiled WHERE ST_Within(ST_SetSRID(ST_Point(%s,%s),3035),geom)", (easting, northing))
-            results = cur.fetchall()
-            if len(results) == 1:
-                (code, name) = results[0]
-                if not _ref:
-                    cur.execute("INSERT INTO cell (ref, code) VALUES(%s, %s)", (ref, code))
-                else:
-                    cur.execute("UPDATE cell SET code = %s WHERE ref = %s", (code, ref))
-                pending += 1
-                found += 1
-            elif len(results) > 1:
-                print label, "surplus", (ref, easting, northing)
-                extra += 1
-            else:
-                print label, "missing", (ref, easting, northing)
-                missing += 1
-        
-            if pending >= commit_buffer:
-                print label, "commit", n
-                conn.commit()
-                pending = 0
+def sample_hits(n, hits):
+    # (point, value) hits to a value and hit count per point
+    values = numpy.zeros(n, dtype=numpy.uint8)
+    counts = numpy.zeros(n, dtype=numpy.uint8)
+    if len(hits) > 0:
+        (points, codes) = zip(*hits)
+        values[list(points)] = codes
+        counts[:] = numpy.bincount(points, minlength=n)
+    return (values, counts)
+
+def sample_corine_db(cur, tile, eastings, northings):
+    cur.execute("SELECT p.k, c.code FROM (SELECT generate_series(0, %s) AS k, unnest(%s::float8[]) AS x, unnest(%s::float8[]) AS y) AS p JOIN clc_tiled AS c ON ST_Within(ST_SetSRID(ST_Point(p.x,p.y),3035),c.geom)",
+        (len(eastings) - 1, eastings.tolist(), northings.tolist()))
+    hits = []
+    for (k, code) in cur.fetchall():
+        if code in cell_code_index:
+            hits.append((k, cell_code_index[code]))
+        else:
+            print 'unknown corine code', code
+    return sample_hits(len(eastings), hits)
+
+def tile_bounds(tile):
+    (xi, yi, n_x, n_y) = tile
+    x0 = min_x + (xi * step)
+    y0 = min_y + (yi * step)
+    return (x0, y0, x0 + (n_x * step), y0 + (n_y * step))
+
+def sample_corine_raster(cur, tile, eastings, northings):
+    (xi, yi, n_x, n_y) = tile
+    (x0, y0, x1, y1) = tile_bounds(tile)
+
+    # clc_tiled pieces can be far larger than a tile, so PostGIS clips them
+    # to a step beyond it and only that part is transferred and parsed
+    cur.execute("SELECT code, " + wkb_column('ST_Intersection(geom, b)', 27700) + " FROM clc_tiled, (SELECT ST_Transform(ST_Expand(ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s),ST_Point(%s,%s)),27700),%s),3035) AS b) AS t WHERE ST_Intersects(geom, b)",
+        (x0, y0, x1, y1, step))
+    shapes = []
+    for (code, wkb) in cur.fetchall():
+        if code in cell_code_index:
+            for part in polygon_parts(wkb_geom(wkb)):
+                shapes.append((part, cell_code_index[code]))
         else:
-            skipped += 1
+            print 'unknown corine code', code
+    (values, counts) = rasterize(shapes, x0, y0, n_x, n_y, step)
 
-    conn.commit()
+    # tile_grid() walks each column in turn, i.e. the transposed raster
+    return (values.T.ravel(), counts.T.ravel())
 
-    print label, 'finish', time.time()
-    print label, "found = %d, missing = %d, extra = %d, skipped = %d" % (found, missing, extra, skipped)
+def sample_lcm_db(cur, tile, eastings, northings):
+    cur.execute("SELECT p.k, l.bh, l.bhsub FROM (SELECT generate_series(0, %s) AS k, unnest(%s::float8[]) AS x, unnest(%s::float8[]) AS y) AS p JOIN lcm2007_polygon AS l ON ST_Within(ST_SetSRID(ST_Point(p.x,p.y),4326),l.the_geom)",
+        (len(eastings) - 1, eastings.tolist(), northings.tolist()))
+    hits = []
+    for (k, bh, bhsub) in cur.fetchall():
+        hits.append((k, cell_code_index["%03d" % (map_lcm(bh, bhsub),)]))
+    return sample_hits(len(eastings), hits)
 
-    cur.close()
-    conn.close()
+def write_tile(layer, tile, values):
+    (xi, yi, n_x, n_y) = tile
+    raster[layer][yi:yi + n_y, xi:xi + n_x] = values.reshape((n_x, n_y)).T
 
-def process_lcm_points(label, coords):
+def process_code_points(label, results, tiles):
     global shutdown
 
-    commit_buffer = 1000
     (conn, cur) = open_db()
 
     found = 0
     missing = 0
     extra = 0
     skipped = 0
-    pending = 0
     n = 0
 
     print label, 'start', time.time()
 
-    for (ref, easting, northing) in coords:
+    for tile in tiles:
         if shutdown:
             print label, 'shutdown'
             return
 
         n += 1
-        cur.execute("SELECT ref, code FROM cell WHERE ref = %s", (ref,))
-        results = cur.fetchall()
-        code = None
-        _ref = None
-        if len(results) != 0:
-            (_ref, code) = results[0]
-        
-        if code is None:
-            cur.execute("SELECT bh, bhsub FROM lcm2007_polygon WHERE ST_Within(ST_SetSRID(ST_Point(%s,%s),4326),the_geom)", (easting, northing))
-            results = cur.fetchall()
-            if len(results) == 1:
-                (bh, bhsub) = results[0]
-                code = "%03d" % (map_lcm(bh, bhsub),)
-                if not _ref:
-                    cur.execute("INSERT INTO cell (ref, code) VALUES(%s, %s)", (ref, code))
-                else:
-                    cur.execute("UPDATE cell SET code = %s WHERE ref = %s", (code, ref))
-                pending += 1
-                found += 1
-            elif len(results) > 1:
-                print label, "surplus", (ref, easting, northing)
-                extra += 1
-            else:
-                print label, "missing", (ref, easting, northing)
-                missing += 1
-        
-            if pending >= commit_buffer:
-                print label, "commit", n
-                conn.commit()
-                pending = 0
-        else:
-            skipped += 1
-
-    conn.commit()
+        if bitmap_test(done_map, tile_index(tile)):
+            skipped += tile[2] * tile[3]
+            continue
+        (xs, ys) = tile_grid(tile)
+        (eastings, northings) = map_point(xs, ys)
+        (values, counts) = sample_code(cur, tile, eastings, northings)
+
+        refs = grid_refs(xs, ys)
+        for k in numpy.flatnonzero(counts == 0):
+            print label, "missing", (refs[k], eastings[k], northings[k])
+        for k in numpy.flatnonzero(counts > 1):
+            print label, "surplus", (refs[k], eastings[k], northings[k])
+        found += numpy.count_nonzero(counts == 1)
+        missing += numpy.count_nonzero(counts == 0)
+        extra += numpy.count_nonzero(counts > 1)
+
+        values[counts != 1] = 0
+        write_tile(layer, tile, values)
+        bitmap_set(done_map, tile_index(tile))
+
+    raster[layer].flush()
 
     print label, 'finish', time.time()
     print label, "found = %d, missing = %d, extra = %d, skipped = %d" % (found, missing, extra, skipped)
@@ -223,88 +180,86 @@ def pick_category(data):
     print 'undecided', data
     return None
 
-def process_osm_points(label, coords):
+osm_tables = ['planet_osm_point', 'planet_osm_line', 'planet_osm_polygon']
+osm_columns = ['name', 'aeroway', 'building', 'highway', 'junction', 'landuse', 'man_made', 'natural', 'railway', 'surface', 'water', 'waterway', 'wetland', 'wood']
+osm_distance = 15.0
+
+def load_osm_features(cur, min_e, min_n, max_e, max_n):
+    features = []
+    for table in osm_tables:
+        cur.execute("SELECT " + ','.join(map(lambda c:'o.' + c, osm_columns)) + "," + wkb_column('way') + " FROM " + table + " AS o WHERE (boundary is null) AND (way is not null) AND ST_DWithin(way,ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s),ST_Point(%s,%s)),900913),%s)", (min_e, min_n, max_e, max_n, osm_distance))
+        for result in cur.fetchall():
+            c = { 'table': table }
+            for (k, v) in zip(osm_columns, result[:-1]):
+                if v is not None:
+                    c[k] = v
+            # the category travels with the geometry the index hands back
+            geom = wkb_geom(result[-1])
+            geom.category = classify_osm(c)
+            features.append(geom)
+    return features
+
+def process_osm_points(label, results, tiles):
     global shutdown
 
-    commit_buffer = 1000
     (conn, cur) = open_db()
 
     found = 0
     missing = 0
     extra = 0
     skipped = 0
-    pending = 0
     n = 0
 
     print label, 'start', time.time()
 
-    for (ref, easting, northing) in coords:
+    for tile in tiles:
         if shutdown:
             print label, 'shutdown'
             return
 
         n += 1
-        
-        cur.execute("SELECT ref, category FROM cell WHERE ref = %s", (ref,))
-        results = cur.fetchall()
-        category = None
-        _ref = None
-        if len(results) != 0:
-            (_ref, category) = results[0]
-        
-        if category is None:
-            cs = []
-            for table in ['planet_osm_point', 'planet_osm_line', 'planet_osm_polygon']:
-                cur.execute("SELECT o.name,o.aeroway,o.building,o.highway,o.junction,o.landuse,o.man_made,o.natural,o.railway,o.surface,o.water,o.waterway,o.wetland,o.wood,ST_Distance(way,ST_Transform(ST_SetSRID(ST_Point(%s,%s),4326),900913)) AS distance FROM " + table + " AS o WHERE (boundary is null) AND (way is not null) AND ST_DWithin(way,ST_Transform(ST_SetSRID(ST_Point(%s,%s),4326),900913),%s) ORDER BY distance", (easting, northing, easting, northing, 15.0))
-                results = cur.fetchall()
-               
-                for result in results:
-                    (name, aeroway, building, highway, junction, landuse, man_made, natural, railway, surface, water, waterway, wetland, wood, distance) = result
-                    c = { 'table': table, 'name': name, 'aeroway': aeroway, 'building': building, 'highway': highway, 'junction': junction, 'landuse': landuse, 'man_made': man_made, 'natural': natural, 'railway': railway, 'surface': surface, 'water': water, 'waterway': waterway, 'wetland': wetland, 'wood': wood, 'distance': distance }
-                    ks = c.keys()
-                    for k in ks:
-                        if c[k] is None:
-                            del c[k]
-                    cs.append(c)
-            
+        if bitmap_test(done_map, tile_index(tile)):
+            skipped += tile[2] * tile[3]
+            continue
+        (xs, ys) = tile_grid(tile)
+        (eastings, northings) = map_point(xs, ys)
+        values = numpy.zeros(len(xs), dtype=numpy.uint8)
+
+        # index every feature near the tile once, in the sampling projection
+        features = load_osm_features(cur, eastings.min(), northings.min(), eastings.max(), northings.max())
+        if len(features) > 0:
+            tree = STRtree(features)
+
+        for (k, (easting, northing)) in enumerate(zip(eastings.tolist(), northings.tolist())):
             category = None
 
-            if len(cs) > 0:
-                found += 1
-                best = None
+            if len(features) > 0:
+                p = Point(easting, northing)
                 best_d = {}
-                for c in cs:
-                    category = classify_osm(c)
-                    if category:
-                        if not best:
-                            best = [category]
-                        else:
-                            best.append(category)
-                        if category in best_d:
-                            if c['distance'] < best_d[category]:
-                                best_d[category] = c['distance']
-                        else:
-                            best_d[category] = c['distance']
-                if best:
+                near = False
+                for geom in tree.query(box(easting - osm_distance, northing - osm_distance, easting + osm_distance, northing + osm_distance)):
+                    distance = geom.distance(p)
+                    if distance > osm_distance:
+                        continue
+                    near = True
+                    c_category = geom.category
+                    if c_category:
+                        if (c_category not in best_d) or (distance < best_d[c_category]):
+                            best_d[c_category] = distance
+                if near:
+                    found += 1
+                if len(best_d) > 0:
                     category = pick_category(sorted(best_d, key=best_d.get))
 
             if category:
-                if not _ref:
-                    cur.execute("INSERT INTO cell (ref, category) VALUES(%s, %s)", (ref, category))
-                else:
-                    cur.execute("UPDATE cell SET category = %s WHERE ref = %s", (category, ref))
-                pending += 1
+                values[k] = osm_category_index[category]
             else:
                 missing += 1
-            
-            if pending >= commit_buffer:
-                print label, "commit", n
-                conn.commit()
-                pending = 0
-        else:
-            skipped += 1
 
-    conn.commit()
+        write_tile(layer, tile, values)
+        bitmap_set(done_map, tile_index(tile))
+
+    raster[layer].flush()
 
     print label, 'finish', time.time()
     print label, "found = %d, missing = %d, extra = %d, skipped = %d" % (found, missing, extra, skipped)
@@ -312,117 +267,82 @@ def process_osm_points(label, coords):
     cur.close()
     conn.close()
 
-def compute_types(label, coords):
-    global shutdown
-    global output_type_map
-
-    (conn, cur) = open_db()
-
-    n = 0
+def export_types():
+    print 'export start', time.time()
 
-    print label, 'start', time.time()
+    # every (code, category) pair the layers can hold, classified once;
+    # the Corine code wins over an LCM code as the first to fill cell.code did
+    classes = numpy.zeros((len(cell_codes), len(osm_categories)), dtype=numpy.uint8)
+    for (i, code) in enumerate(cell_codes):
+        for (j, category) in enumerate(osm_categories):
+            classes[i,j] = map_code_category(code, category)
 
-    curr = []
-    refs = [curr]
-    for (ref, easting, northing) in coords:
-        curr.append(int(ref))
-        if len(curr) >= 10000:
-            curr = []
-            refs.append(curr)
+    rows = max(int(tile_size / step), 1)
+    for y in range(0, raster_info['height'], rows):
+        codes = raster['corine'][y:y + rows]
+        codes = numpy.where(codes != 0, codes, raster['lcm'][y:y + rows])
+        raster['type'][y:y + rows] = classes[codes, raster['osm'][y:y + rows]]
+        print 'export', y
+    raster['type'].flush()
 
-    for rs in refs:
-        if shutdown:
-            print label, 'shutdown'
-            return
-        
-        mapping = {}
-        cur.execute("SELECT ref,code,category FROM cell WHERE ref = ANY(%s);", (rs,))
-        for (_ref, code, category) in cur.fetchall():
-            mapping[_ref] = map_code_category(code, category)
-            print "%12d '%s' '%s' => %d" % (_ref, code, category, mapping[_ref])
-
-        for ref in rs:
-            r = str(ref)
-            x = int(r[0:6])
-            y = int(r[6:12])
-            idx = reference_index(x, y)
-
-            if ref in mapping:
-                output_type_map[idx] = mapping[ref]
-            else:
-                output_type_map[idx] = H_NONE # unknown
-            n += 1
+    print 'export finish', time.time()
 
-    print label, 'finish', time.time()
-    
-    cur.close()
-    conn.close()
-
-def verify_points(label, coords):
+def verify_points(label, results, tiles):
     global shutdown
-    global output_stats
     (conn, cur) = open_db()
 
-    n = 0
-    checked = 0
-    matched = 0
-    matched_abs = 0
-    errors = dict_with_keys2(habitat_types)
-    coverage_h = dict_with_keys(habitat_types)
-    coverage_l = dict_with_keys(habitat_types)
+    # confusion[h_type][lcm_type] over every grid point
+    confusion = numpy.zeros((256, 256), dtype=numpy.int64)
 
     print label, 'start', time.time()
 
-    for (ref, easting, northing) in coords:
+    for tile in tiles:
         if shutdown:
             print label, 'shutdown'
             return
-        
-        cur.execute("SELECT bh,bhsub FROM lcm2007_polygon WHERE ST_Within(ST_Transform(ST_SetSRID(ST_Point(%s,%s),27700),4326),the_geom)", (easting, northing))
-        results = cur.fetchall()
-        if len(results) >= 1:
-            (bh, bhsub) = results[0]
-            lcm_type = map_lcm(bh, bhsub)
-        else:
-            (bh, bhsub) = ('', '')
-            lcm_type = H_NONE
 
-        cur.execute("SELECT h_type FROM habitat WHERE ST_Within(ST_Transform(ST_SetSRID(ST_Point(%s,%s),27700),4326),geom)", (easting, northing))
-        results = cur.fetchall()
-        if len(results) >= 1:
-            h_type = results[0][0]
-        else:
-            h_type = H_NONE
-
-        n += 1
-        coverage_h[h_type] += 1
-        coverage_l[lcm_type] += 1
-        if (h_type != H_NONE):
-            checked += 1
-            if (h_type == lcm_type):
-                matched += 1
-        if (h_type == lcm_type):
-            matched_abs += 1
-        else:
-            # print ref, easting, northing, bh, bhsub, lcm_type, h_type
-            errors[h_type][lcm_type] += 1
+        (xi, yi, n_x, n_y) = tile
+        (x0, y0, x1, y1) = tile_bounds(tile)
+
+        cur.execute("SELECT bh, bhsub, " + wkb_column('the_geom', 27700) + " FROM lcm2007_polygon WHERE the_geom && ST_Transform(ST_Expand(ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s),ST_Point(%s,%s)),27700),%s),4326)",
+            (x0, y0, x1, y1, step))
+        lcm = []
+        for (bh, bhsub, wkb) in cur.fetchall():
+            lcm.append((wkb_geom(wkb), map_lcm(bh, bhsub)))
+
+        cur.execute("SELECT h_type, " + wkb_column('geom_osgb') + " FROM habitat WHERE geom_osgb && ST_Expand(ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s),ST_Point(%s,%s)),27700),%s)",
+            (x0, y0, x1, y1, step))
+        habitats = []
+        for (h_type, wkb) in cur.fetchall():
+            habitats.append((wkb_geom(wkb), h_type))
+
+        # both layers rasterized onto the grid of the tile, then compared
+        # point for point; painted in reverse so where shapes overlap the
+        # first one found wins, as it did when points were looked up
+        (lcm_types, _) = rasterize(lcm[::-1], x0, y0, n_x, n_y, step)
+        (h_types, _) = rasterize(habitats[::-1], x0, y0, n_x, n_y, step)
+        pairs = (h_types.ravel().astype(numpy.int64) * 256) + lcm_types.ravel()
+        confusion += numpy.bincount(pairs, minlength=(256 * 256)).reshape((256, 256))
 
     print label, 'finish', time.time()
-    print label, n, matched_abs, checked, matched
+    print label, confusion.sum(), numpy.trace(confusion)
 
-    output_stats['checked'] += checked
-    output_stats['matched'] += matched
-    output_stats['checked_abs'] += n
-    output_stats['matched_abs'] += matched_abs
-    for k in habitat_types:
-        for t in habitat_types:
-            output_stats['mapping_errors'][k][t] += errors[k][t]
-        output_stats['coverage_h'][k] += coverage_h[k]
-        output_stats['coverage_l'][k] += coverage_l[k]
+    results.put(confusion)
 
     cur.close()
     conn.close()
 
+def collect_confusion(confusion):
+    global output_confusion
+    output_confusion += confusion
+
+def tile_index(tile):
+    # position of a tile in the order produced by grid_tiles()
+    (xi, yi, n_x, n_y) = tile
+    n = max(int(tile_size / step), 1)
+    tiles_y = (int(height / step) + n - 1) / n
+    return ((xi / n) * tiles_y) + (yi / n)
+
 # bootstrap
 width = max_x - min_x
 height = max_y - min_y
@@ -432,96 +352,122 @@ base_x = int(math.floor(min_x / step))
 base_y = int(math.floor(min_y / step))
 base_width = int(math.ceil(width / step))
 
-def reference_index(x, y):
-    return int(((math.floor(y / step) - base_y) * base_width) + (math.floor(x / step) - base_x))
-
-def gridref(coord):
-    (x, y) = coord
-    ref = '%06d%06d' % (math.floor(x / step) * int(step), math.floor(y / step) * int(step))
-    return ref
+def grid_refs(xs, ys):
+    # integer form of '%06d%06d' % (x, y) snapped to the grid
+    xs = (numpy.floor(xs / step) * int(step)).astype(numpy.int64)
+    ys = (numpy.floor(ys / step) * int(step)).astype(numpy.int64)
+    return (xs * 1000000) + ys
+
+def open_grid_raster():
+    n_x = int(width / step)
+    n_y = int(height / step)
+    if not os.path.exists(raster_file):
+        create_raster(raster_file, step, base_x, base_y, n_x, n_y)
+    (info, layers) = open_raster(raster_file)
+    if (info['step'], info['base_x'], info['base_y'], info['width'], info['height']) != (int(step), base_x, base_y, n_x, n_y):
+        print 'raster', raster_file, 'does not match config.py'
+        sys.exit(1)
+    return (info, layers)
     
 # command line
 mode = None
 output = None
+collect = None
+layer = None
+done_map = None
 if len(sys.argv) >= 2:
     mode = sys.argv[1]
 if len(sys.argv) >= 3:
     output = sys.argv[2]
 
-if not ((mode == 'corine') or (mode == 'lcm') or (mode == 'osm') or (mode == 'route') or (mode == 'verify')):
-    print 'compute-grid [corine|lcm|osm|route|verify]'
+if not ((mode == 'corine') or (mode == 'corine-raster') or (mode == 'lcm') or (mode == 'osm') or (mode == 'route') or (mode == 'verify')):
+    print 'compute-grid [corine|corine-raster|lcm|osm|route|verify]'
     sys.exit(1)
 
 if mode == 'corine':
     map_point = osgb36_to_etrs89
-    process_points = process_corine_points
+    process_points = process_code_points
+    sample_code = sample_corine_db
+    layer = 'corine'
+elif mode == 'corine-raster':
+    map_point = osgb36_to_etrs89
+    process_points = process_code_points
+    sample_code = sample_corine_raster
+    layer = 'corine'
 elif mode == 'lcm':
     map_point = osgb36_to_wgs84
-    process_points = process_lcm_points
+    process_points = process_code_points
+    sample_code = sample_lcm_db
+    layer = 'lcm'
 elif mode == 'osm':
-    map_point = osgb36_to_wgs84
+    map_point = osgb36_to_mercator
     process_points = process_osm_points
+    layer = 'osm'
 elif mode == 'route':
-    map_point = lambda x:x
-    process_points = compute_types
-    ref_index = reference_index
-    output_type_map = bytearray(reference_index(max_x + step, max_y + step))
-    print output_type_map
+    map_point = lambda xs, ys:(xs, ys)
+    process_points = None
 elif mode == 'verify':
-    step = 100.0
-    map_point = lambda x:x
+    map_point = lambda xs, ys:(xs, ys)
     process_points = verify_points
-    output_stats = { 
-        'checked': 0,
-        'checked_abs': 0,
-        'matched': 0,
-        'matched_abs': 0,
-        'coverage_h': dict_with_keys(habitat_types),
-        'coverage_l': dict_with_keys(habitat_types),
-        'mapping_errors': dict_with_keys2(habitat_types)
-    }
+    collect = collect_confusion
+    output_confusion = numpy.zeros((256, 256), dtype=numpy.int64)
+
+# samples live in the raster store, one byte per grid point and layer;
+# tiles already sampled for a layer are recorded in data.<layer>.done so
+# an interrupted run resumes without revisiting them
+if layer or (mode == 'route'):
+    (raster_info, raster) = open_grid_raster()
+if layer:
+    n_tiles = len(list(grid_tiles(width, height, step, tile_size)))
+    done_map = open_bitmap('data.%s.done' % layer, n_tiles)
 
 # compute work
 points = 0
 def generate_work():
     global points
-    for p in grid_points(min_x, min_y, width, height, step):
-        (easting, northing) = map_point(p)
-        ref = gridref(p)
-        points += 1
-        yield (ref, easting, northing)
+    for tile in grid_tiles(width, height, step, tile_size):
+        (xi, yi, n_x, n_y) = tile
+        points += n_x * n_y
+        yield tile
 
 # process work
-do_thread_par(generate_work(), n_workers, process_points) 
+if process_points:
+    do_stream_par(generate_work(), n_workers, process_points, collect)
+else:
+    export_types()
 
 # output results
 if output:
     # Print unique codes
-    list_of_seen = []
-    for i in range(len(output_type_map)):
-        if (output_type_map[i] in list_of_seen) == False:
-            print output_type_map[i]
-            list_of_seen.append(output_type_map[i])
+    counts = numpy.bincount(raster['type'].ravel(), minlength=256)
+    for t in numpy.flatnonzero(counts):
+        print t
 
+    # the raster store can be given to route directly; this writes the
+    # older single layer routing file from the same view
     fh = open(output, 'wb')
-    fh.write("%06d %06d %06d %06d %d\n" % (step, base_x, base_y, base_width, len(output_type_map)))
-    fh.write(output_type_map)
+    fh.write("%06d %06d %06d %06d %d\n" % (step, base_x, base_y, raster_info['width'], raster['type'].size))
+    raster['type'].tofile(fh)
     fh.close()
-if output_stats:
-    print 'checked:', output_stats['checked']
-    print 'matched:', output_stats['matched']
-    print 'checked_abs:', output_stats['checked_abs']
-    print 'matched_abs:', output_stats['matched_abs']
-    errors = output_stats['checked_abs'] - output_stats['matched_abs']
+if output_confusion is not None:
+    matched_abs = numpy.trace(output_confusion)
+    checked = output_confusion.sum() - output_confusion[H_NONE,:].sum()
+    print 'checked:', checked
+    print 'matched:', matched_abs - output_confusion[H_NONE,H_NONE]
+    print 'checked_abs:', output_confusion.sum()
+    print 'matched_abs:', matched_abs
+    errors = output_confusion.sum() - matched_abs
     for k in habitat_types:
-        v_h = output_stats['coverage_h'][k]
-        v_l = output_stats['coverage_l'][k]
+        v_h = output_confusion[k,:].sum()
+        v_l = output_confusion[:,k].sum()
         pc_h = (float(v_h) / float(points)) * 100.0
         pc_l = (float(v_l) / float(points)) * 100.0
         print 'coverage %02d h:% 8d (% 2.1f), l:% 8d (% 2.1f)' % (k, v_h, pc_h, v_l, pc_l)
     for k in habitat_types:
         for t in habitat_types:
-            v = output_stats['mapping_errors'][k][t]
+            if k == t:
+                continue
+            v = output_confusion[k,t]
             pc = (float(v) / float(errors)) * 100.0
             if v > 0:
                 print "error %02d -> %02d, count: % 7d, % 2.1f" % (k, t, v, pc)
@@ -13,5 +13,7 @@ min_y = 503005.0
 max_y = 540005.0
 
 step = 10.0 # m
+tile_size = 1000.0 # m
+raster_file = 'habitats.raster'
 
 initial_simplify = 10.0 # m
@@ -4,11 +4,10 @@ import sys
 import psycopg2
 import json
 
-import shapely.wkt
-from shapely.ops import cascaded_union
-
 from habitats import *
 
+link_distance = 10.0 # m
+
 type_map = {
    H_NONE: 'none',
    H_URBAN: 'hab_builtup',
@@ -25,52 +24,42 @@ type_map = {
 conn = psycopg2.connect("dbname=gis")
 cur = conn.cursor()
 
-cur.execute("SELECT polygon_id, h_type, ST_AsText(geom) FROM habitat")
+cur.execute("SELECT polygon_id, h_type FROM habitat")
 results = cur.fetchall()
 
 h_types = {}
-geoms = {}
 
-for (_id, h_type, geom) in results:
+for (_id, h_type) in results:
     h_types[_id] = h_type
-    geoms[_id] = geom
 
-links = {}
+# every pair of habitats within link_distance, in one indexed self-join
+cur.execute("SELECT a.polygon_id, b.polygon_id FROM habitat a, habitat b WHERE (a.polygon_id < b.polygon_id) AND ST_DWithin(a.geom_osgb, b.geom_osgb, %s)", (link_distance,))
+pairs = cur.fetchall()
 
+links = {}
 for _id in h_types.keys():
-    cur.execute("SELECT polygon_id FROM habitat WHERE (polygon_id != %s) AND ST_DWithin(ST_Transform(geom,27700), ST_Transform(ST_SetSRID(ST_GeomFromText(%s),4326),27700), 10)", (_id, geoms[_id]))
-    matches = cur.fetchall()
-    
-    ms = []
-    for (o_id,) in matches:
-        ms.append(o_id)
-    links[_id] = set(ms)
-    links[_id].add(_id)
-
-conns = {}
+    links[_id] = set([_id])
+for (a, b) in pairs:
+    links[a].add(b)
+    links[b].add(a)
 
+rows = []
 for link_id in h_types.keys():
     conns = links[link_id]
     if len(conns) > 1:
         print 'insert', link_id, conns 
         for value in conns:
-            cur.execute("INSERT INTO habitat_link (link_id, polygon_id) VALUES(%s, %s)", (link_id, value))
+            rows.append((link_id, value))
     else:
         print 'skip', link_id, conns
 
-#for _id in h_types.keys():
-#    for link in links[_id]:
-#        transitive = (set()).union(links[link])
-#        rep = transitive.intersection(links[_id])
-#        conns[str(rep)] = rep
+copy_rows(cur, 'habitat_link', ['link_id', 'polygon_id'], rows)
+
+# connected groups of the link graph
+rows = link_groups(h_types.keys(), pairs)
+print 'groups', len(set(r[0] for r in rows)), 'habitats', len(rows)
 
-#for (link_id, key) in enumerate(conns.keys()):
-#    if len(conns[key]) > 1:
-#        print 'insert', link_id, key
-#        for value in conns[key]:
-#            cur.execute("INSERT INTO habitat_link (link_id, polygon_id) VALUES(%s, %s)", (link_id, value))
-#    else:
-#        print 'skip', link_id, key
+copy_rows(cur, 'habitat_group', ['group_id', 'polygon_id'], rows)
 
 conn.commit()
 conn.close()
@@ -5,7 +5,6 @@ import sys
 import psycopg2
 import os
 
-import shapely.wkt
 from shapely.geometry import Point
 from shapely.ops import cascaded_union
 
@@ -14,18 +13,18 @@ from config import *
 
 n_workers = os.sysconf(os.sysconf_names['SC_NPROCESSORS_ONLN'])
 
-def process_polygons(label, queue, polygons):
+def process_polygons(label, results, polygons):
     conn = psycopg2.connect("dbname=gis")
     cur = conn.cursor()
 
     try:
         skipped = 0
         for (polygon_id, gid) in polygons:
-            cur.execute("SELECT bh, bhsub, ST_AsText(ST_Transform(the_geom,27700)) FROM lcm2007_polygon WHERE gid = %s", (gid,))
-            results = cur.fetchall()
-            if len(results) > 0:
-                (bh, bhsub, wkt) = results[0]
-                polygon = shapely.wkt.loads(wkt)
+            cur.execute("SELECT bh, bhsub, " + wkb_column('the_geom', 27700) + " FROM lcm2007_polygon WHERE gid = %s", (gid,))
+            rows = cur.fetchall()
+            if len(rows) > 0:
+                (bh, bhsub, wkb) = rows[0]
+                polygon = wkb_geom(wkb)
 
                 if polygon.is_valid and polygon.geom_type == 'Polygon':
                     polygon = polygon.simplify(initial_simplify)
@@ -35,21 +34,17 @@ def process_polygons(label, queue, polygons):
 
                 polygon_type = map_lcm(bh, bhsub) 
                     
-                print label, polygon_id, len(str(polygon))
-                cur.execute("INSERT INTO habitat_raw (polygon_id, h_type, geom) VALUES(%s,%s,ST_Transform(ST_SetSRID(ST_GeomFromText(%s),27700),4326));",
-                    (polygon_id, polygon_type, str(polygon)))
+                print label, polygon_id, polygon_vertices(polygon)
+                insert_habitat(cur, 'habitat_raw', polygon_id, polygon_type, polygon)
                 conn.commit()
             else:
                 skipped += 1
-            if not queue.empty():
-                return
         print label, "skipped =", skipped
     except KeyboardInterrupt:
         pass
 
     conn.commit()
     conn.close()
-    queue.close()
 
 def load_polygon_ids(min_x, max_x, min_y, max_y):
     conn = psycopg2.connect("dbname=gis")
@@ -68,4 +63,4 @@ def load_polygon_ids(min_x, max_x, min_y, max_y):
 ### main program
 
 data = load_polygon_ids(min_x, max_x, min_y, max_y)
-do_process_par(data, n_workers, process_polygons) 
+do_stream_par(data, n_workers, process_polygons, chunk=16)
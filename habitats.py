@@ -1,9 +1,25 @@
 #!/usr/bin/env python
 
 import multiprocessing
-import threading
+import Queue
+import itertools
+import time
+import cStringIO
+import pyproj
+import numpy
+import mmap
+import struct
 import sys
 import os
+import psycopg2
+import shapely.wkb
+import scipy.ndimage
+from shapely.geometry import Polygon, MultiPolygon
+
+etrs89 = pyproj.Proj(init='epsg:3035')
+osgb36 = pyproj.Proj(init='epsg:27700')
+wgs84 = pyproj.Proj(init='epsg:4326')
+mercator = pyproj.Proj(init='epsg:3857') # osm2pgsql 900913
 
 H_NONE          = 0
 H_URBAN         = 10
@@ -35,6 +51,24 @@ habitat_types = [
     H_MOUNTAIN
 ]
 
+# Corine Land Cover nomenclature followed by the LCM derived codes, indexed
+# so a code fits in a byte
+cell_codes = [
+    None,
+    '111', '112', '121', '122', '123', '124', '131', '132', '133', '141',
+    '142', '211', '212', '213', '221', '222', '223', '231', '241', '242',
+    '243', '244', '311', '312', '313', '321', '322', '323', '324', '331',
+    '332', '333', '334', '335', '411', '412', '421', '422', '423', '511',
+    '512', '521', '522', '523', '990', '995', '999'
+] + map(lambda t:'%03d' % t, habitat_types)
+cell_code_index = dict((code, i) for (i, code) in enumerate(cell_codes))
+
+osm_categories = [
+    None, 'build', 'build+', 'trans', 'agri', 'grass', 'wood', 'water',
+    'wetland', 'mud', 'marsh', 'heath', 'scrub', 'none'
+]
+osm_category_index = dict((c, i) for (i, c) in enumerate(osm_categories))
+
 classify_natural = {
     'wetland':      'wetland',
     'wood':         'wood',
@@ -69,6 +103,21 @@ classify_landuse = {
     'allotments':   'grass'
 }
 
+# projections take scalars or whole coordinate arrays in a single call
+def osgb36_to_wgs84(eastings, northings):
+    return pyproj.transform(osgb36, wgs84, eastings, northings)
+
+def osgb36_to_etrs89(eastings, northings):
+    return pyproj.transform(osgb36, etrs89, eastings, northings)
+
+def osgb36_to_mercator(eastings, northings):
+    return pyproj.transform(osgb36, mercator, eastings, northings)
+
+def osgb36_box_to_etrs89(min_x, min_y, max_x, max_y):
+    # a box in EPSG:3035 covering one in EPSG:27700, from its corners
+    (xs, ys) = osgb36_to_etrs89([min_x, max_x, min_x, max_x], [min_y, min_y, max_y, max_y])
+    return (min(xs), min(ys), max(xs), max(ys))
+
 def map_code_category(code, category):
     if not code:
         return H_NONE
@@ -200,88 +249,604 @@ def map_lcm(bh, bhsub):
 
     return H_NONE
 
-shutdown = True
+def open_bitmap(path, n_bits):
+    # one bit per unit of work, memory mapped so it survives a crashed run
+    size = max((n_bits + 7) / 8, 1)
+    if not os.path.exists(path):
+        fh = open(path, 'wb')
+        fh.write('\0' * size)
+        fh.close()
+    if os.path.getsize(path) != size:
+        print 'bitmap', path, 'does not match the work; remove it to start again'
+        sys.exit(1)
+    fh = open(path, 'r+b')
+    bitmap = mmap.mmap(fh.fileno(), size)
+    fh.close()
+    return bitmap
+
+def bitmap_test(bitmap, i):
+    return (ord(bitmap[i >> 3]) >> (i & 7)) & 1
+
+bitmap_lock = multiprocessing.Lock()
+
+def bitmap_set(bitmap, i):
+    bitmap_lock.acquire()
+    try:
+        bitmap[i >> 3] = chr(ord(bitmap[i >> 3]) | (1 << (i & 7)))
+    finally:
+        bitmap_lock.release()
+
+# raster store: a text header padded to raster_header_size followed by one
+# row-major byte layer per source, each addressed in place through a memmap
+raster_magic = 'habitats-raster 1'
+raster_header_size = 4096
+raster_layers = ['corine', 'lcm', 'osm', 'type']
+
+def create_raster(path, step, base_x, base_y, width, height):
+    header = "%s\nstep %d\nbase_x %d\nbase_y %d\nwidth %d\nheight %d\nlayers %s\n" % (
+        raster_magic, step, base_x, base_y, width, height, ' '.join(raster_layers))
+    fh = open(path, 'wb')
+    fh.write(header.ljust(raster_header_size, '\0'))
+    fh.truncate(raster_header_size + (len(raster_layers) * width * height))
+    fh.close()
+
+def open_raster(path, mode='r+'):
+    fh = open(path, 'rb')
+    lines = fh.read(raster_header_size).rstrip('\0').split('\n')
+    fh.close()
+    if lines[0] != raster_magic:
+        print path, 'is not a habitats raster'
+        sys.exit(1)
+
+    info = {}
+    for line in lines[1:]:
+        if line:
+            (k, v) = line.split(' ', 1)
+            if k == 'layers':
+                info[k] = v.split(' ')
+            else:
+                info[k] = int(v)
+    data = numpy.memmap(path, dtype=numpy.uint8, mode=mode, offset=raster_header_size,
+        shape=(len(info['layers']), info['height'], info['width']))
+    layers = {}
+    for (i, name) in enumerate(info['layers']):
+        layers[name] = data[i]
+    return (info, layers)
+
+# scanline rasterization of polygons onto a regular grid of points
+def scanline_crossings(coords, y0, n_y, step):
+    # rows j with y_lo <= y0 + j * step < y_hi cross an edge exactly once
+    xy = numpy.asarray(coords, dtype=numpy.float64)
+    (x1, y1) = (xy[:-1,0], xy[:-1,1])
+    (x2, y2) = (xy[1:,0], xy[1:,1])
+    r0 = numpy.clip(numpy.ceil((numpy.minimum(y1, y2) - y0) / step), 0, n_y).astype(numpy.int64)
+    r1 = numpy.clip(numpy.ceil((numpy.maximum(y1, y2) - y0) / step), 0, n_y).astype(numpy.int64)
+    n = r1 - r0
+    edges = numpy.repeat(numpy.arange(len(n)), n)
+    rows = numpy.repeat(r0, n) + (numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n))
+    py = y0 + (rows * step)
+    xs = x1[edges] + ((py - y1[edges]) * (x2[edges] - x1[edges]) / (y2[edges] - y1[edges]))
+    return (rows, xs)
+
+def geometry_rings(geom):
+    for part in getattr(geom, 'geoms', [geom]):
+        yield part.exterior
+        for interior in part.interiors:
+            yield interior
+
+def rasterize(shapes, x0, y0, n_x, n_y, step):
+    # even-odd scanline fill of (geom, value) shapes at the points
+    # (x0 + i * step, y0 + j * step), counting how many shapes hit each point
+    values = numpy.zeros((n_y, n_x), dtype=numpy.uint8)
+    counts = numpy.zeros((n_y, n_x), dtype=numpy.uint8)
+    for (geom, value) in shapes:
+        rows = []
+        xs = []
+        for ring in geometry_rings(geom):
+            (r, x) = scanline_crossings(ring.coords, y0, n_y, step)
+            rows.append(r)
+            xs.append(x)
+        rows = numpy.concatenate(rows)
+        xs = numpy.concatenate(xs)
+        if len(rows) == 0:
+            continue
+
+        # sorted crossings pair up into spans along each row
+        order = numpy.lexsort((xs, rows))
+        rows = rows[order]
+        xs = xs[order]
+        c0 = numpy.clip(numpy.ceil((xs[0::2] - x0) / step), 0, n_x).astype(numpy.int64)
+        c1 = numpy.clip(numpy.ceil((xs[1::2] - x0) / step), 0, n_x).astype(numpy.int64)
+        size = n_y * (n_x + 1)
+        spans = numpy.bincount((rows[0::2] * (n_x + 1)) + c0, minlength=size) - numpy.bincount((rows[1::2] * (n_x + 1)) + c1, minlength=size)
+        mask = numpy.cumsum(spans.reshape((n_y, n_x + 1)), axis=1)[:,:n_x] > 0
+
+        values[mask] = value
+        counts += mask
+    return (values, counts)
+
+# outlines of the union of squares around lattice points, traced from the
+# cells they cover rather than by unioning buffers
+
+# unit moves for the four directions boundary edges can take
+trace_moves = [(1, 0), (0, 1), (-1, 0), (0, -1)] # E, N, W, S
+
+def cover_cells(xs, ys, step, buffer):
+    # each point covers the square of side 2 * buffer around it, which on a
+    # lattice of step sized cells is r x r cells either side of it
+    r = max(int(round(buffer / step)), 1)
+    x0 = xs.min() - (r * step)
+    y0 = ys.min() - (r * step)
+    i = numpy.rint((xs - x0) / step).astype(numpy.int64)
+    j = numpy.rint((ys - y0) / step).astype(numpy.int64)
+    # one cell of padding on every side so boundary edges never hit the edge
+    cells = numpy.zeros((i.max() + r + 2, j.max() + r + 2), dtype=numpy.bool_)
+    for di in range(-r, r):
+        for dj in range(-r, r):
+            cells[i + di + 1, j + dj + 1] = True
+    return (cells, x0 - step, y0 - step)
+
+def boundary_edges(cells):
+    # directed unit edges between covered and uncovered cells, oriented so
+    # the covered cell is on the left; cell (a, b) spans vertices (a, b) to
+    # (a + 1, b + 1)
+    edges = set()
+    empty_below = cells[:, 1:] & ~cells[:, :-1]
+    empty_above = cells[:, :-1] & ~cells[:, 1:]
+    empty_left = cells[1:, :] & ~cells[:-1, :]
+    empty_right = cells[:-1, :] & ~cells[1:, :]
+    for (mask, da, db, d) in ((empty_below, 0, 1, 0), (empty_above, 1, 1, 2), (empty_left, 1, 1, 3), (empty_right, 1, 0, 1)):
+        (ii, jj) = numpy.nonzero(mask)
+        for (a, b) in zip(ii.tolist(), jj.tolist()):
+            edges.add((a + da, b + db, d))
+    return edges
+
+def split_ring(ring):
+    # cut a ring that passes through a vertex more than once into loops that
+    # each pass through it once
+    loops = []
+    path = []
+    seen = {}
+    for v in ring:
+        if v in seen:
+            k = seen[v]
+            loops.append(path[k:])
+            for u in path[k + 1:]:
+                del seen[u]
+            del path[k + 1:]
+        else:
+            seen[v] = len(path)
+            path.append(v)
+    loops.append(path)
+    return loops
+
+def trace_rings(edges):
+    # follow edges into closed rings, keeping only the corners; where cells
+    # meet only at a vertex take the left turn, then split the ring there
+    # so the loops either side become rings of their own
+    remaining = set(edges)
+    rings = []
+    while remaining:
+        start = remaining.pop()
+        (x, y, d) = start
+        ring = []
+        while True:
+            (dx, dy) = trace_moves[d]
+            (x, y) = (x + dx, y + dy)
+            for turn in (1, 0, 3):
+                nd = (d + turn) % 4
+                if (x, y, nd) in edges:
+                    break
+            if nd != d:
+                ring.append((x, y))
+            d = nd
+            if (x, y, d) == start:
+                break
+            remaining.remove((x, y, d))
+        rings.extend(split_ring(ring))
+    return rings
+
+def ring_area(ring):
+    # signed, positive for anti-clockwise rings
+    area = 0
+    for k in range(len(ring)):
+        (x1, y1) = ring[k - 1]
+        (x2, y2) = ring[k]
+        area += (x1 * y2) - (x2 * y1)
+    return area / 2.0
+
+def trace_polygon(xs, ys, step, buffer):
+    # outline of the union of the squares of side 2 * buffer around points on
+    # a lattice of the given step, in time proportional to its boundary;
+    # anti-clockwise rings are shells and clockwise rings holes
+    (cells, x0, y0) = cover_cells(xs, ys, step, buffer)
+    shells = []
+    holes = []
+    for ring in trace_rings(boundary_edges(cells)):
+        coords = [(x0 + (a * step), y0 + (b * step)) for (a, b) in ring]
+        if ring_area(ring) > 0:
+            shells.append(coords)
+        else:
+            holes.append(coords)
+
+    polygons = []
+    for shell in shells:
+        polygons.append((Polygon(shell), []))
+    for hole in holes:
+        if len(polygons) == 1:
+            polygons[0][1].append(hole)
+            continue
+        p = Polygon(hole).representative_point()
+        for (shell, shell_holes) in polygons:
+            if shell.contains(p):
+                shell_holes.append(hole)
+                break
+
+    polygons = [Polygon(shell.exterior.coords, shell_holes) for (shell, shell_holes) in polygons]
+    if len(polygons) == 1:
+        return polygons[0]
+    else:
+        return MultiPolygon(polygons)
+
+# geometry crosses the database boundary as WKB; wkb_column() selects a
+# column as WKB, optionally reprojected, for wkb_geom() to read, and
+# wkb_param() passes a geometry for ST_GeomFromWKB(%s, srid)
+def wkb_column(column, srid=None):
+    if srid:
+        column = "ST_Transform(%s,%d)" % (column, srid)
+    return "ST_AsBinary(%s)" % column
+
+def wkb_geom(data):
+    return shapely.wkb.loads(str(data))
+
+def wkb_param(geom):
+    return psycopg2.Binary(geom.wkb)
+
+def polygon_parts(geom):
+    # the polygons of an intersection, which may also hold lines and points
+    if geom.geom_type == 'Polygon':
+        return [geom]
+    return [g for g in getattr(geom, 'geoms', []) if g.geom_type == 'Polygon']
+
+def polygon_vertices(polygon):
+    return sum([len(ring.coords) - 1 for ring in [polygon.exterior] + list(polygon.interiors)])
+
+def ewkb_hex(wkb, srid):
+    # WKB with the SRID spliced into its header, hex encoded as COPY takes it
+    endian = '<' if wkb[0] == '\x01' else '>'
+    (geom_type,) = struct.unpack(endian + 'I', wkb[1:5])
+    return (wkb[0] + struct.pack(endian + 'II', geom_type | 0x20000000, srid) + wkb[5:]).encode('hex')
+
+def insert_habitats(cur, table, rows):
+    # rows of (polygon_id, h_type, geom) with geom in EPSG:27700, written in
+    # one statement; habitat tables keep it alongside the WGS84 copy and its
+    # area so searches and ordering can use their indexes
+    if not rows:
+        return
+    cur.execute("INSERT INTO " + table + " (polygon_id, h_type, area, geom_osgb, geom) SELECT polygon_id, h_type, area, g, ST_Transform(g, 4326) FROM (SELECT polygon_id, h_type, area, ST_GeomFromWKB(wkb,27700) AS g FROM (SELECT unnest(%s::int[]) AS polygon_id, unnest(%s::int[]) AS h_type, unnest(%s::float8[]) AS area, unnest(%s::bytea[]) AS wkb) AS r) AS s",
+        ([r[0] for r in rows], [r[1] for r in rows], [r[2].area for r in rows], [wkb_param(r[2]) for r in rows]))
 
-def worker_shutdown_required():
-    global shutdown
-    return shutdown
+def insert_habitat(cur, table, polygon_id, h_type, geom):
+    insert_habitats(cur, table, [(polygon_id, h_type, geom)])
 
-def do_thread_par(data, n_workers, th):
-    global shutdown
+def group_reduce(ufunc, inverse, n, values):
+    # ufunc reduced over the values of each of n groups, numbered by inverse
+    # as numpy.unique() returns it; ufunc.at needs numpy 1.8
+    order = numpy.argsort(inverse, kind='mergesort')
+    starts = numpy.searchsorted(inverse[order], numpy.arange(n))
+    return ufunc.reduceat(values[order], starts)
 
-    shutdown = False
+# union-find over dense integer ids held in a numpy parent array, every
+# set rooted at its smallest member
+def uf_create(n):
+    return numpy.arange(n, dtype=numpy.int64)
+
+def uf_flatten(parent):
+    # point every id directly at its root
+    while True:
+        grand = parent[parent]
+        if (grand == parent).all():
+            return parent
+        parent[:] = grand
+
+def uf_union(parent, a, b):
+    # merge the sets of each a[k], b[k] pair
+    a = numpy.asarray(a, dtype=numpy.int64)
+    b = numpy.asarray(b, dtype=numpy.int64)
+    while len(a) > 0:
+        uf_flatten(parent)
+        ra = parent[a]
+        rb = parent[b]
+        differ = ra != rb
+        (a, b, ra, rb) = (a[differ], b[differ], ra[differ], rb[differ])
+        if len(a) == 0:
+            break
+        # each root joins the smallest root it is paired with
+        (hi, inverse) = numpy.unique(numpy.maximum(ra, rb), return_inverse=True)
+        parent[hi] = group_reduce(numpy.minimum, inverse, len(hi), numpy.minimum(ra, rb))
+    return uf_flatten(parent)
+
+def merge_clusters(ids, areas, a, b):
+    # connected groups of the candidate graph over dense indices into ids,
+    # each ordered largest first so it merges under its largest polygon
+    order = numpy.argsort(ids)
+    a = order[numpy.searchsorted(ids, numpy.array(a, dtype=numpy.int64), sorter=order)]
+    b = order[numpy.searchsorted(ids, numpy.array(b, dtype=numpy.int64), sorter=order)]
+    if len(a) == 0:
+        return (a, [])
+
+    parent = uf_union(uf_create(len(ids)), a, b)
+    members = numpy.unique(numpy.concatenate((a, b)))
+    members = members[numpy.lexsort((-areas[members], parent[members]))]
+    roots = parent[members]
+    starts = numpy.flatnonzero(numpy.r_[True, roots[1:] != roots[:-1]])
+    return (members, numpy.split(members, starts[1:]))
+
+def link_groups(polygon_ids, pairs):
+    # (group_id, polygon_id) rows for the connected groups of linked
+    # polygons, each group named after its smallest polygon_id; polygons
+    # without links are left out
+    ids = numpy.array(sorted(polygon_ids), dtype=numpy.int64)
+    a = numpy.searchsorted(ids, numpy.array([p[0] for p in pairs], dtype=numpy.int64))
+    b = numpy.searchsorted(ids, numpy.array([p[1] for p in pairs], dtype=numpy.int64))
+    parent = uf_union(uf_create(len(ids)), a, b)
+    sizes = numpy.bincount(parent, minlength=len(ids))
+    return [(int(ids[parent[i]]), int(ids[i])) for i in numpy.flatnonzero(sizes[parent] > 1)]
+
+# connected components of the type raster, labelled a tile at a time and
+# stitched together across the seams between tiles
+
+# 8-connectivity, as route follows diagonals
+label_connectivity = numpy.ones((3, 3), dtype=numpy.int32)
+
+def label_tiles(height, width, tile):
+    for yi in range(0, height, tile):
+        for xi in range(0, width, tile):
+            yield (slice(yi, min(yi + tile, height)), slice(xi, min(xi + tile, width)))
+
+def label_tile_types(types, first):
+    # label each type in a tile separately, numbering from first
+    labels = numpy.zeros(types.shape, dtype=numpy.uint32)
     n = 0
-    work = []
-    for i in range(n_workers):
-        work.append([])
-    for p in data:
-        work[n].append(p)
-        n = (n + 1) % n_workers
+    for t in numpy.unique(types):
+        if t == 0:
+            continue
+        (found, k) = scipy.ndimage.label(types == t, structure=label_connectivity)
+        mask = found > 0
+        labels[mask] = found[mask] + (first + n)
+        n += k
+    return (labels, n)
 
-    # execute
-    workers = []
-    for i in range(n_workers):
-        label = "worker %d" % (i + 1)
-        worker = threading.Thread(target=th, args=(label,work[i]))
-        worker.start()
-        workers.append(worker)
+def label_types(types, labels, tile):
+    # provisional labels, unique within each tile; returns how many
+    n_labels = 0
+    for (rows, cols) in label_tiles(types.shape[0], types.shape[1], tile):
+        (tile_labels, n) = label_tile_types(numpy.array(types[rows, cols]), n_labels)
+        n_labels += n
+        if n_labels >= (1 << 32):
+            print 'too many components for the label raster'
+            sys.exit(1)
+        labels[rows, cols] = tile_labels
+    return n_labels
+
+def seam_pairs(types_a, labels_a, types_b, labels_b):
+    # labels of equal type touching across a seam, straight or diagonally;
+    # a and b are the lines of cells either side of it
+    pairs = []
+    n = len(types_a)
+    for d in (-1, 0, 1):
+        ia = numpy.arange(max(0, -d), min(n, n - d))
+        ib = ia + d
+        match = (types_a[ia] != 0) & (types_a[ia] == types_b[ib])
+        pairs.append((labels_a[ia][match], labels_b[ib][match]))
+    return pairs
+
+def stitch(types, labels, n_labels, tile):
+    # union-find over the provisional labels joined across the seams
+    (height, width) = types.shape
+    parent = uf_create(n_labels + 1)
+    a = []
+    b = []
+    for x in range(tile, width, tile):
+        for (la, lb) in seam_pairs(types[:, x - 1], labels[:, x - 1], types[:, x], labels[:, x]):
+            a.append(la)
+            b.append(lb)
+    for y in range(tile, height, tile):
+        for (la, lb) in seam_pairs(types[y - 1, :], labels[y - 1, :], types[y, :], labels[y, :]):
+            a.append(la)
+            b.append(lb)
+    if a:
+        uf_union(parent, numpy.concatenate(a), numpy.concatenate(b))
+    return parent
+
+def relabel(types, labels, parent, tile):
+    # number the merged components 1..n in place and gather their type, size
+    # and bounding box in grid cells
+    (height, width) = types.shape
+    roots = numpy.unique(parent[1:])
+    lut = numpy.searchsorted(roots, parent).astype(numpy.uint32) + 1
+    lut[0] = 0
+    n = len(roots)
+
+    c_type = numpy.zeros(n + 1, dtype=numpy.uint8)
+    c_count = numpy.zeros(n + 1, dtype=numpy.int64)
+    c_min_x = numpy.zeros(n + 1, dtype=numpy.int64) + width
+    c_min_y = numpy.zeros(n + 1, dtype=numpy.int64) + height
+    c_max_x = numpy.zeros(n + 1, dtype=numpy.int64) - 1
+    c_max_y = numpy.zeros(n + 1, dtype=numpy.int64) - 1
 
-    shutdown = False
-    while not shutdown:
+    for (rows, cols) in label_tiles(height, width, tile):
+        ids = lut[labels[rows, cols]]
+        labels[rows, cols] = ids
+        (ys, xs) = numpy.nonzero(ids)
+        ids = ids[ys, xs]
+        if len(ids) == 0:
+            continue
+        c_type[ids] = types[rows, cols][ys, xs]
+        # only the components present in the tile are touched
+        (present, inverse) = numpy.unique(ids, return_inverse=True)
+        n_present = len(present)
+        c_count[present] += numpy.bincount(inverse)
+        c_min_x[present] = numpy.minimum(c_min_x[present], group_reduce(numpy.minimum, inverse, n_present, xs + cols.start))
+        c_min_y[present] = numpy.minimum(c_min_y[present], group_reduce(numpy.minimum, inverse, n_present, ys + rows.start))
+        c_max_x[present] = numpy.maximum(c_max_x[present], group_reduce(numpy.maximum, inverse, n_present, xs + cols.start))
+        c_max_y[present] = numpy.maximum(c_max_y[present], group_reduce(numpy.maximum, inverse, n_present, ys + rows.start))
+
+    return zip(range(1, n + 1), c_type[1:], c_count[1:], c_min_x[1:], c_min_y[1:], c_max_x[1:], c_max_y[1:])
+
+# output coordinates are written to 1e-6 degrees; in compact mode as
+# integers of that unit, each relative to the previous point
+precision = 6
+quantum = 10 ** precision
+
+def habitat_points(shape, compact=False):
+    return ring_points(shape.exterior, compact)
+
+def habitat_holes(shape, compact=False):
+    # the interior rings of a polygon, each encoded as its exterior is
+    return [ring_points(ring, compact) for ring in shape.interiors]
+
+def ring_points(ring, compact=False):
+    coords = numpy.array(ring.coords)[:-1]
+    if compact:
+        q = numpy.rint(coords * quantum).astype(numpy.int64)
+        q[1:] -= q[:-1].copy()
+        return q.ravel().tolist()
+    return numpy.round(coords, precision).ravel().tolist()
+
+def copy_value(v):
+    if v is None:
+        return '\\N'
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def copy_rows(cur, table, columns, rows):
+    # stream rows into table with a single COPY
+    buf = cStringIO.StringIO()
+    for row in rows:
+        buf.write('\t'.join(map(copy_value, row)))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_from(buf, table, columns=columns)
+
+# reporting interval for do_stream_par
+progress_interval = 10.0 # s
+
+def chunk_units(units, size):
+    chunk = []
+    for unit in units:
+        chunk.append(unit)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def stream_units(work, progress, slot, ended):
+    while True:
+        chunk = work.get()
+        if chunk is None:
+            ended.append(True)
+            return
+        for unit in chunk:
+            yield unit
+            # resumed once the unit is done
+            progress[slot] += 1
+
+def stream_worker(ph, label, work, results, progress, slot):
+    ended = []
+    try:
+        ph(label, results, stream_units(work, progress, slot, ended))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # tell the scheduler this worker has finished
+        results.put(None)
+    if not ended:
+        # ph returned before the end of the work, dropping what it had taken
+        print label, 'stopped before the work was done'
+        sys.exit(1)
+
+def drain_results(results, collect, block):
+    finished = 0
+    while True:
         try:
-            for worker in workers:
-                worker.join()
-            shutdown = True
-        except:
-            # force
-            shutdown = True
+            v = results.get(block, 0.1)
+        except Queue.Empty:
+            return finished
+        if v is None:
+            finished += 1
+        elif collect:
+            collect(v)
+        block = False
 
-def do_process_par(data, n_workers, ph):
-    global shutdown
+def workers_alive(workers):
+    for worker in workers:
+        if worker.is_alive():
+            return True
+    return False
 
-    shutdown = False
+def report_progress(progress, total, last):
+    now = time.time()
+    if (now - last) < progress_interval:
+        return last
+    done = sum(progress)
+    print 'progress', done, '/', (total if total is not None else '?'), '(' + ' '.join(map(str, progress)) + ')'
+    return now
 
-    n = 0
-    work = []
-    for i in range(n_workers):
-        work.append([])
-    for p in data:
-        work[n].append(p)
-        n = (n + 1) % n_workers
+def do_stream_par(source, n_workers, ph, collect=None, queue_size=4, cost=None, chunk=1):
+    # stream units from source through a bounded queue to a pool of worker
+    # processes, each pulling the next chunk of units as it finishes the
+    # last; ph(label, results, units) consumes units as they arrive and
+    # anything it puts on results is passed to collect() in this process
+    # while work is still being handed out.  Given cost(unit), units are
+    # handed out most costly first, which reads the whole of source before
+    # any is handed out.  A worker failing, or returning before it has been
+    # told the work is done, ends the run with an error.
+    if cost:
+        source = sorted(source, key=cost, reverse=True)
+    total = len(source) if hasattr(source, '__len__') else None
+
+    work = multiprocessing.Queue(queue_size * n_workers)
+    results = multiprocessing.Queue()
+    progress = multiprocessing.Array('l', n_workers, lock=False)
 
     print 'par begin...'
-    # execute
     workers = []
-    queues = []
     for i in range(n_workers):
         label = "worker %d" % (i + 1)
-        queue = multiprocessing.Queue()
-        queues.append(queue)
-        worker = multiprocessing.Process(target=ph, args=(label,queue,work[i]))
+        worker = multiprocessing.Process(target=stream_worker, args=(ph,label,work,results,progress,i))
         worker.start()
         workers.append(worker)
 
-    shutdown = False
-    while not shutdown:
-        try:
-            for worker in workers:
-                worker.join()
-            shutdown = True
-        except:
-            # force
-            shutdown = True
-
-    print 'par end...'
-    results = []
-    for queue in queues:
-        done = False
-        while not done:
+    running = n_workers
+    last = time.time()
+    chunks = itertools.chain(chunk_units(source, chunk), [None] * n_workers)
+    for c in chunks:
+        while (running > 0) and workers_alive(workers):
             try:
-                v = queue.get_nowait()
-                results.append(v)
-            except:
-                done = True
-        queue.close()
-    print 'par end... complete'
-
-    return results
+                work.put(c, True, 0.1)
+                break
+            except Queue.Full:
+                running -= drain_results(results, collect, False)
+                last = report_progress(progress, total, last)
+        running -= drain_results(results, collect, False)
+        if (running == 0) or not workers_alive(workers):
+            # nobody left to take the rest of the work
+            work.cancel_join_thread()
+            break
+
+    while (running > 0) and workers_alive(workers):
+        running -= drain_results(results, collect, True)
+        last = report_progress(progress, total, last)
+    # results posted just before the last workers exited
+    drain_results(results, collect, True)
+
+    for worker in workers:
+        worker.join()
+    print 'par end...', sum(progress), 'units'
+
+    # the units a failed or stopped worker had taken are lost
+    failed = [worker.name for worker in workers if worker.exitcode != 0]
+    if failed:
+        print 'par failed:', len(failed), 'of', n_workers, 'workers exited with an error'
+        sys.exit(1)
@@ -1,13 +1,21 @@
-create table cell (ref bigint, code char(3), category char(10));
-create unique index on cell (ref);
-
-create table habitat_raw (polygon_id int, h_type int);
+create table habitat_raw (polygon_id int, h_type int, area float8);
 select AddGeometryColumn ('','habitat_raw','geom',4326,'POLYGON',2);
+select AddGeometryColumn ('','habitat_raw','geom_osgb',27700,'POLYGON',2);
 create index habitat_raw_gix on habitat_raw using GIST (geom);
+create index habitat_raw_osgb_gix on habitat_raw using GIST (geom_osgb);
+create index on habitat_raw (polygon_id);
+create index on habitat_raw (h_type, area);
 
-create table habitat (polygon_id int, h_type int);
+create table habitat (polygon_id int, h_type int, area float8);
 select AddGeometryColumn ('','habitat','geom',4326,'POLYGON',2);
+select AddGeometryColumn ('','habitat','geom_osgb',27700,'POLYGON',2);
 create index habitat_gix on habitat using GIST (geom);
+create index habitat_osgb_gix on habitat using GIST (geom_osgb);
+create index on habitat (polygon_id);
+create index on habitat (h_type, area);
 
 create table habitat_link (link_id int, polygon_id int);
 create index on habitat_link (polygon_id);
+
+create table habitat_group (group_id int, polygon_id int);
+create index on habitat_group (polygon_id);
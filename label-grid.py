@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import numpy
+import time
+import sys
+
+from habitats import *
+from config import *
+
+# cells per side of the tiles labelled in memory at once
+label_tile = 2048
+
+if len(sys.argv) < 2:
+    print "label-grid <output-prefix>"
+    sys.exit(1)
+
+prefix = sys.argv[1]
+
+(info, layers) = open_raster(raster_file, mode='r')
+types = layers['type']
+(height, width) = types.shape
+
+# provisional labels, unique within each tile, then merged across the
+# seams between tiles; only one tile of cells is ever held in memory
+labels = numpy.lib.format.open_memmap(prefix + '.npy', mode='w+', dtype=numpy.uint32, shape=(height, width))
+
+print 'label start', time.time()
+n_labels = label_types(types, labels, label_tile)
+print 'labelled', n_labels, time.time()
+
+parent = stitch(types, labels, n_labels, label_tile)
+print 'stitched', time.time()
+
+components = relabel(types, labels, parent, label_tile)
+labels.flush()
+print 'components', len(components), time.time()
+
+# one line per component: id, type, points and bounding box in metres
+fh = open(prefix + '.txt', 'w')
+fh.write("step %d base_x %d base_y %d\n" % (info['step'], info['base_x'], info['base_y']))
+for (c_id, c_type, c_count, c_min_x, c_min_y, c_max_x, c_max_y) in components:
+    fh.write("%d %d %d %d %d %d %d\n" % (c_id, c_type, c_count,
+        (c_min_x + info['base_x']) * info['step'], (c_min_y + info['base_y']) * info['step'],
+        (c_max_x + info['base_x']) * info['step'], (c_max_y + info['base_y']) * info['step']))
+fh.close()
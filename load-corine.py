@@ -1,37 +1,102 @@
 #!/usr/bin/env python
 
-import subprocess
+import sqlite3
 import psycopg2
+import time
 import sys
+import os
+
+from habitats import *
+from config import *
+
+# polygons handed to each writer at a time
+load_batch = 1000
+# margin around the area of interest
+aoi_margin = 5000.0 # m
+n_workers = min(os.sysconf(os.sysconf_names['SC_NPROCESSORS_ONLN']), 8)
+
+# created once the data is in rather than updated row by row
+clc06_indexes = [
+    "CREATE INDEX clc06_gix ON clc06 USING GIST (geom)",
+    "CREATE UNIQUE INDEX clc06_id_idx ON clc06 (id)",
+    "CREATE INDEX clc06_code_idx ON clc06 (code)"
+]
+
+def open_spatialite(path):
+    db = sqlite3.connect(path)
+    db.enable_load_extension(True)
+    for extension in ['mod_spatialite', 'libspatialite']:
+        try:
+            db.load_extension(extension)
+            return db
+        except sqlite3.OperationalError:
+            pass
+    print 'unable to load the spatialite extension'
+    sys.exit(1)
+
+def read_polygons(db, bounds):
+    # rows of (id, code, name, ewkb) in batches, using the spatial index of
+    # the SQLite file when filtering and it has one
+    query = "SELECT OGC_FID, code_06, id, AsBinary(GEOMETRY) FROM clc06"
+    args = ()
+    if bounds:
+        (x0, y0, x1, y1) = bounds
+        indexed = db.execute("SELECT count(*) FROM sqlite_master WHERE name = 'idx_clc06_GEOMETRY'").fetchone()[0]
+        if indexed:
+            query += " WHERE ROWID IN (SELECT pkid FROM idx_clc06_GEOMETRY WHERE xmin <= ? AND xmax >= ? AND ymin <= ? AND ymax >= ?)"
+            args = (x1, x0, y1, y0)
+        else:
+            query += " WHERE MbrIntersects(GEOMETRY, BuildMbr(?, ?, ?, ?))"
+            args = (x0, y0, x1, y1)
+
+    rows = db.execute(query, args)
+    while True:
+        batch = rows.fetchmany(load_batch)
+        if not batch:
+            return
+        yield [(_id, _code, _name, ewkb_hex(str(wkb), 3035)) for (_id, _code, _name, wkb) in batch]
+
+def process_batches(label, results, batches):
+    conn = psycopg2.connect("dbname=gis")
+    cur = conn.cursor()
+
+    n = 0
+    for batch in batches:
+        copy_rows(cur, 'clc06', ['id', 'code', 'name', 'geom'], batch)
+        conn.commit()
+        n += len(batch)
+    print label, 'loaded', n
+
+    cur.close()
+    conn.close()
 
 if len(sys.argv) < 2:
-    print "load-corine.py <clc06-file>"
+    print "load-corine.py <clc06-file> [all]"
     sys.exit(1)
 
 source = sys.argv[1]
+# load all of Europe rather than the area of interest in config.py
+bounds = None
+if 'all' not in sys.argv[2:]:
+    bounds = osgb36_box_to_etrs89(min_x - aoi_margin, min_y - aoi_margin, max_x + aoi_margin, max_y + aoi_margin)
 
 conn = psycopg2.connect("dbname=gis")
 cur = conn.cursor()
+for index in ['clc06_gix', 'clc06_id_idx', 'clc06_code_idx']:
+    cur.execute("DROP INDEX IF EXISTS " + index)
+conn.commit()
 
-p = subprocess.Popen(
-    ['spatialite', source, "SELECT OGC_FID,code_06,id,AsWKT(GEOMETRY) from clc06;"],
-    stdout=subprocess.PIPE
-)
-
-n = 0
-for line in p.stdout:
-    (_id, _code, _name, _wkt) = line.split('|', 3)
-    _id = int(_id)
-    r = cur.execute('insert into clc06 (id, code, name, geom) values(%s, %s, %s, ST_GeomFromText(%s, 3035))',
-        (_id, _code, _name, _wkt))
-    print _id, _name, _code, r
-
-    n += 1
-    if n >= 100:
-        print 'commit'
-        conn.commit()
-        n = 0
+print 'load start', bounds, time.time()
+db = open_spatialite(source)
+do_stream_par(read_polygons(db, bounds), n_workers, process_batches)
+db.close()
 
+print 'index start', time.time()
+for index in clc06_indexes:
+    cur.execute(index)
+cur.execute("ANALYZE clc06")
 conn.commit()
+print 'load finish', time.time()
+
 cur.close()
 conn.close()
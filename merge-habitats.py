@@ -7,8 +7,8 @@ import time
 import sys
 import os
 import json
+import numpy
 
-import shapely.wkt
 from shapely.ops import cascaded_union
 
 from habitats import *
@@ -40,45 +40,26 @@ merge_buffer        = {
    H_MOUNTAIN:      10.0    # m
 }
 output_max_simplify = 50.0 # m
+copy_batch          = 1000  # polygons per load and insert
+merge_batch         = 50    # merged polygons per insert
 
 n_workers = min(os.sysconf(os.sysconf_names['SC_NPROCESSORS_ONLN']), 64)
-areas = {}
-h_types = {}
-merge = {}
-unmerged = {}
-ignore = {}
-
-def add_merge(a, b):
-    if a not in merge:
-        merge[a] = { b: True }
-    else:
-        merge[a][b] = True
-    if b not in merge:
-        merge[b] = { a: True }
-    else:
-        merge[b][a] = True
-
-def adaptive_simplify(geom):
-    s = output_max_simplify
-    while s > 1.0:
-        new_geom = geom.simplify(s)
-        if new_geom.is_valid:
-            return new_geom
-        s = s / 2.0
-    return geom
-
-def process_search(label, habitats):
+# merge candidates found by the search workers, as pairs of polygon ids
+merge_a = []
+merge_b = []
+# polygons whose merge set failed
+failed = []
+
+def process_search(label, results, habitats):
     print label, 'start', time.time()
     
     conn = psycopg2.connect("dbname=gis")
     cur = conn.cursor()
-    
-    for (_id, _type, geom, area) in habitats:
-        if worker_shutdown_required():
-            print label, 'shutdown'
-            return
-        
-        cur.execute("SELECT polygon_id, h_type, ST_Distance(ST_Transform(geom, 27700), ST_Transform(ST_SetSRID(ST_GeomFromText(%s),4326),27700)), ST_Area(ST_Transform(geom, 27700)) FROM habitat_raw WHERE (polygon_id != %s) AND (h_type = %s) AND ST_DWithin(ST_Transform(geom, 27700), ST_Transform(ST_SetSRID(ST_GeomFromText(%s),4326),27700), %s)", (geom, _id, _type, geom, search_distance))
+
+    found_a = []
+    found_b = []
+    for (_id, _type, area) in habitats:
+        cur.execute("SELECT b.polygon_id, b.h_type, ST_Distance(a.geom_osgb, b.geom_osgb), b.area FROM habitat_raw a, habitat_raw b WHERE (a.polygon_id = %s) AND (b.polygon_id != a.polygon_id) AND (b.h_type = a.h_type) AND ST_DWithin(a.geom_osgb, b.geom_osgb, %s)", (_id, search_distance))
         matches = cur.fetchall()
 
         if len(matches) == 0:
@@ -86,98 +67,83 @@ def process_search(label, habitats):
 
         for (o_id, o_type, o_dist, o_area) in matches:
             print ' ', o_id, o_dist
-            if (o_id not in ignore) and (o_dist <= merge_distance[_type]):
-                add_merge(o_id, _id)
-    
+            if o_dist <= merge_distance[_type]:
+                found_a.append(o_id)
+                found_b.append(_id)
+
+    results.put((found_a, found_b))
+
     print label, 'finish', time.time()
 
     conn.commit()
     conn.close()
 
-def process_merge(label, queue, merge_sets):
+def load_geoms(cur, ids):
+    # EPSG:27700 geometry for many polygons in one round trip
+    cur.execute("SELECT polygon_id, " + wkb_column('geom_osgb') + " FROM habitat_raw WHERE polygon_id = ANY(%s)", (ids,))
+    geoms = {}
+    for (_id, g) in cur.fetchall():
+        geoms[_id] = wkb_geom(g)
+    return geoms
+
+def merge_set(label, h_type, to_merge, parts):
+    geoms = []
+    for m_id in to_merge:
+        if m_id in parts:
+            geoms.append(parts[m_id].buffer(merge_buffer[h_type]))
+    validity = map(lambda x:x.is_valid, geoms)
+
+    print label, 'merging', to_merge[0], h_type, len(to_merge)
+    if (len(validity) > 1) and (False not in validity):
+        new_geom = cascaded_union(geoms)
+        if new_geom.geom_type == 'Polygon':
+            new_geom = new_geom.simplify(output_max_simplify)
+            print ' ', new_geom.geom_type, polygon_vertices(new_geom)
+            new_area = new_geom.area
+            print ' ', 'area', new_area
+
+            if new_area < min_size:
+                print ' ', 'too small'
+            else:
+                print ' ', 'commit'
+                return new_geom
+        else:
+            print ' ', 'union is not polygon'
+    else:
+        print ' ', 'seems to contain invalid parts; ignoring...'
+    return None
+
+def collect_search(found):
+    merge_a.extend(found[0])
+    merge_b.extend(found[1])
+
+def process_merge(label, results, merge_sets):
     print label, 'start', time.time()
     
     conn = psycopg2.connect("dbname=gis")
     cur = conn.cursor()
-    
-    for to_merge in merge_sets:
-        geoms = []
-        validity = None
-
-        print label, 'load', to_merge
-        cur.execute("SELECT polygon_id, ST_AsText(ST_Transform(geom, 27700)) FROM habitat_raw WHERE polygon_id = ANY(%s)", (to_merge,))
-        _geoms = cur.fetchall()
-        for (m_id, g) in _geoms:
-            geom = shapely.wkt.loads(g)
-            geoms.append(geom.buffer(merge_buffer[h_types[m_id]]))
-        validity = map(lambda x:x.is_valid, geoms)
-
-        _id = to_merge[0]
-        did_merge = False
-        print label, 'merging', _id, h_types[_id], len(to_merge)
-        if (len(validity) > 1) and (False not in validity):
-            new_geom = cascaded_union(geoms)
-            if new_geom.geom_type == 'Polygon':
-                new_geom = adaptive_simplify(new_geom)
-
-                print ' ', new_geom.geom_type, len(str(new_geom))
-                cur.execute("SELECT ST_Area(ST_SetSRID(ST_GeomFromText(%s), 27700))", (str(new_geom),))
-                new_area = (cur.fetchall())[0][0]
-                print ' ', 'area', new_area
-                
-                if new_area < min_size:
-                    print ' ', 'too small'
-                else:
-                    print ' ', 'commit'
-                    cur.execute("INSERT INTO habitat (polygon_id, h_type, geom) VALUES(%s,%s,ST_Transform(ST_SetSRID(ST_GeomFromText(%s), 27700),4326))", (_id, h_types[_id], str(new_geom)))
-                    conn.commit()
-                    did_merge = True
-            else:
-                print ' ', 'union is not polygon'
-        else:
-            print ' ', 'seems to contain invalid parts; ignoring...'
 
-        if not did_merge:
+    # one set at a time as it is handed out, so the largest go first; the
+    # merged polygons are written merge_batch at a time
+    rows = []
+    for (h_type, to_merge) in merge_sets:
+        parts = load_geoms(cur, to_merge)
+        new_geom = merge_set(label, h_type, to_merge, parts)
+        if new_geom:
+            rows.append((to_merge[0], h_type, new_geom))
+            if len(rows) >= merge_batch:
+                insert_habitats(cur, 'habitat', rows)
+                conn.commit()
+                rows = []
+        else:
             print ' ', 'not merged'
-            for __id in to_merge:
-                queue.put(__id)
-    
+            results.put(to_merge)
+    insert_habitats(cur, 'habitat', rows)
+
     print label, 'finish', time.time()
 
     conn.commit()
     conn.close()
-    queue.close()
-
-def cmp_areas(x, y):
-    return int(areas[x]) - int(areas[y])
-
-def cmp_sets(x, y):
-    return len(x) - len(y)
-
-def fold_candidates_flat(_id):
-    ncs = []
-    search = [ _id ]
-    while len(search) > 0:
-        __id = search.pop()
-        if unmerged[__id]:
-            ncs.append(__id)
-            unmerged[__id] = False
-            cs = merge[__id].keys()
-            cs = sorted(cs, cmp=cmp_areas, reverse=True)
-            for c_id in cs:
-                if unmerged[c_id]:
-                    search.append(c_id)
-    return ncs
-
-def fold_candidates(_id):
-    cs = merge[_id].keys()
-    cs = sorted(cs, cmp=cmp_areas, reverse=True)
-    ncs = [_id]
-    unmerged[_id] = False
-    for c_id in cs:
-        if unmerged[c_id]:
-            ncs.extend(fold_candidates(c_id))
-    return ncs
 
 ### main program
 
@@ -189,71 +155,61 @@ if mode == 'lcm':
         merge_distance[k] /= 2.0
     merge_distance[H_ARABLE] = 0.0
 
-sys.setrecursionlimit(10000)
 conn = psycopg2.connect("dbname=gis")
 cur = conn.cursor()
 
-cur.execute("SELECT polygon_id, h_type, ST_AsText(geom), ST_Area(ST_Transform(geom, 27700)) FROM habitat_raw ORDER BY ST_Area(ST_Transform(geom, 27700)) ASC;")
+cur.execute("SELECT polygon_id, h_type, area FROM habitat_raw ORDER BY area ASC;")
 results = cur.fetchall()
 
 # First filter the none habitats as these are not used
 filtered_results = []
-for (_id, _type, geom, area) in results:
+for (_id, _type, area) in results:
     print 'habitat type', type_map[_type], _type, 'id', _id, 'area', area
     ok = True
     ok = ok and (_type != H_NONE)
     #ok = ok and (area <= max_size)
     #ok = ok and (not ((_type == H_WATER) and (area >= max_size_water)))
     if ok:
-        filtered_results.append((_id, _type, geom, area))
+        filtered_results.append((_id, _type, area))
     else:
         print ' ', 'ignore', _id
-        ignore[_id] = True
 results = filtered_results
 
-for (_id, _type, geom, area) in results:
-    areas[_id] = area
-    h_types[_id] = _type
-    if _id not in unmerged:
-        unmerged[_id] = True
+# polygons by dense index
+ids = numpy.array([r[0] for r in results], dtype=numpy.int64)
+h_types = numpy.array([r[1] for r in results], dtype=numpy.int32)
+areas = numpy.array([r[2] for r in results], dtype=numpy.float64)
 
 # do parallel search
-do_thread_par(results, n_workers, process_search)
+do_stream_par(results, n_workers, process_search, collect_search, chunk=16)
 
 # compute merge
-ids = merge.keys()
-ids = sorted(ids, cmp=cmp_areas, reverse=True)
-merge_sets = []
-for _id in ids:
-    if unmerged[_id]:
-        merge_sets.append(fold_candidates_flat(_id))
-
-ids = unmerged.keys()
-for _id in ids:
-    if not unmerged[_id]:
-        del unmerged[_id]
-
-# sort the work by size
-#  this will allow even distribution by do_process_par
-merge_sets = sorted(merge_sets, cmp=cmp_sets, reverse=True)
-
-# perform parallel merge
-result = do_process_par(merge_sets, n_workers, process_merge)
-for _id in result:
-    unmerged[_id] = True
+(merged, clusters) = merge_clusters(ids, areas, merge_a, merge_b)
+unmerged = numpy.ones(len(ids), dtype=numpy.bool_)
+unmerged[merged] = False
+
+merge_sets = [(int(h_types[c[0]]), ids[c].tolist()) for c in clusters]
+
+# perform parallel merge, largest sets first
+do_stream_par(merge_sets, n_workers, process_merge, failed.extend, cost=lambda m:len(m[1]))
+order = numpy.argsort(ids)
+unmerged[order[numpy.searchsorted(ids, numpy.array(failed, dtype=numpy.int64), sorter=order)]] = True
 
 # handle remaining data
-ids = unmerged.keys()
-for _id in ids:
-    if areas[_id] >= min_size:
+remaining = numpy.flatnonzero(unmerged)
+for i in remaining[areas[remaining] < min_size]:
+    print 'skip', ids[i]
+remaining = remaining[areas[remaining] >= min_size]
+for k in range(0, len(remaining), copy_batch):
+    batch = remaining[k:k + copy_batch]
+    parts = load_geoms(cur, ids[batch].tolist())
+    rows = []
+    for i in batch:
+        (_id, h_type) = (int(ids[i]), int(h_types[i]))
         print 'copy', _id
-        cur.execute("SELECT ST_AsText(ST_Transform(geom, 27700)) FROM habitat_raw WHERE polygon_id = %s", (_id,))
-        geom = shapely.wkt.loads((cur.fetchall())[0][0])
-        geom = geom.buffer(merge_buffer[h_types[_id]])
-        geom = adaptive_simplify(geom)
-        cur.execute("INSERT INTO habitat (polygon_id, h_type, geom) VALUES(%s,%s,ST_Transform(ST_SetSRID(ST_GeomFromText(%s),27700),4326))", (_id, h_types[_id], str(geom)))
-    else:
-        print 'skip', _id
+        geom = parts[_id].buffer(merge_buffer[h_type]).simplify(output_max_simplify)
+        rows.append((_id, h_type, geom))
+    insert_habitats(cur, 'habitat', rows)
 conn.commit()
 
 # shutdown
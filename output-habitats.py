@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 
 import sys
+import os
+import math
 import psycopg2
 import json
+import gzip
 
-import shapely.wkt
+from shapely.geometry import box
+from shapely.ops import transform
 
 from habitats import *
 
@@ -21,16 +25,168 @@ limits = {
     H_MOUNTAIN:     0
 }
 
+# expands compact point arrays in place once the file has loaded
+decoder = """(function (hs, q) {
+  for (var i = 0; i < hs.length; ++i) {
+    var p = hs[i].points, x = 0, y = 0;
+    for (var k = 0; k < p.length; k += 2) {
+      x += p[k]; y += p[k + 1];
+      p[k] = x / q; p[k + 1] = y / q;
+    }
+  }
+})(ESD.modelDescriptor['habitats'], %d);
+""" % quantum
+
+# tile pyramid: zoom levels written, simplification in screen pixels at
+# each zoom and the most vertices a tile may hold, largest habitats first
+tile_zooms = range(8, 15)
+tile_tolerance = 1.0 # px
+tile_vertex_budget = 20000
+earth_circumference = 2 * math.pi * 6378137.0 # m
+
+def dump(v, fh, compact=False):
+    if compact:
+        json.dump(v, fh, sort_keys=True, separators=(',', ':'))
+    else:
+        json.dump(v, fh, sort_keys=True, indent=2)
+
+def habitat_rows(conn):
+    # habitats by type, largest first, through server side cursors so only
+    # a batch of rows is held at a time
+    for h_type in limits.keys():
+        if limits[h_type] > 0:
+            cur = conn.cursor('habitats_%d' % h_type)
+            cur.itersize = 500
+            cur.execute("SELECT polygon_id, h_type, " + wkb_column('geom') + " FROM habitat WHERE h_type = %s ORDER BY area DESC LIMIT %s;", (h_type, limits[h_type]))
+            for row in cur:
+                yield row
+            cur.close()
+
+def tile_range(z, bounds):
+    # x, y tiles covering a lon/lat box
+    n = 2 ** z
+    def tile_y(lat):
+        lat = math.radians(max(min(lat, 85.0511), -85.0511))
+        return int((1.0 - (math.log(math.tan(lat) + (1.0 / math.cos(lat))) / math.pi)) / 2.0 * n)
+    (min_lon, min_lat, max_lon, max_lat) = bounds
+    xs = range(int((min_lon + 180.0) / 360.0 * n), int((max_lon + 180.0) / 360.0 * n) + 1)
+    ys = range(tile_y(max_lat), tile_y(min_lat) + 1)
+    return [(x, y) for x in xs for y in ys]
+
+def tile_box(z, x, y):
+    n = 2 ** z
+    lat = lambda y: math.degrees(math.atan(math.sinh(math.pi * (1.0 - (2.0 * y / n)))))
+    return box((x * 360.0 / n) - 180.0, lat(y + 1), ((x + 1) * 360.0 / n) - 180.0, lat(y))
+
+def part_polygons(part):
+    # the polygons left after clipping, which may also have produced lines
+    if part.geom_type == 'Polygon':
+        return [part]
+    return [g for g in getattr(part, 'geoms', []) if g.geom_type == 'Polygon']
+
+def tile_habitats(conn, min_area):
+    # habitats of at least min_area, largest first, through a server side
+    # cursor so only a batch of rows is held at a time
+    cur = conn.cursor('tiles')
+    cur.itersize = 500
+    cur.execute("SELECT polygon_id, h_type, " + wkb_column('geom_osgb') + " FROM habitat WHERE h_type != %s AND area >= %s ORDER BY area DESC", (H_NONE, min_area))
+    for (_id, _type, geom) in cur:
+        yield (_id, _type, wkb_geom(geom))
+    cur.close()
+
+def write_tiles(conn, directory, links, transports):
+    # every habitat, cut into a z/x/y pyramid of JSON files written a zoom
+    # at a time; each zoom is simplified to a pixel at that zoom and drops
+    # habitats under a pixel
+    cur = conn.cursor()
+    cur.execute("SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(geom_osgb) AS e FROM habitat WHERE h_type != %s) AS s", (H_NONE,))
+    (x0, y0, x1, y1) = cur.fetchone()
+    cur.close()
+    if x0 is None:
+        return
+
+    # metres per pixel at the latitude of the habitats
+    (lons, lats) = osgb36_to_wgs84([x0, x1, x0, x1], [y0, y0, y1, y1])
+    (min_lon, min_lat, max_lon, max_lat) = (min(lons), min(lats), max(lons), max(lats))
+    scale = math.cos(math.radians((min_lat + max_lat) / 2.0)) * earth_circumference / 256.0
+
+    for z in tile_zooms:
+        pixel = scale / (2 ** z)
+        # entries and vertex count of each tile; a tile takes whole
+        # habitats until the next one would go over the budget, then no more
+        tiles = {}
+        full = set()
+        for (_id, _type, shape) in tile_habitats(conn, pixel * pixel):
+            geom = shape.simplify(pixel * tile_tolerance)
+            if geom.area < (pixel * pixel):
+                continue
+            geom = transform(osgb36_to_wgs84, geom)
+            for (x, y) in tile_range(z, geom.bounds):
+                if (x, y) in full:
+                    continue
+                polygons = part_polygons(geom.intersection(tile_box(z, x, y)))
+                if not polygons:
+                    continue
+                (entries, vertices) = tiles.get((x, y), ([], 0))
+                n = sum(map(polygon_vertices, polygons))
+                if vertices + n > tile_vertex_budget:
+                    full.add((x, y))
+                    tiles[(x, y)] = (entries, vertices)
+                    continue
+                for polygon in polygons:
+                    entries.append({
+                        'id': str(_id),
+                        'type': type_map[_type],
+                        'points': habitat_points(polygon),
+                        'holes': habitat_holes(polygon),
+                        'regulation': [],
+                        'links': map(str, links.get(_id, []))
+                    })
+                tiles[(x, y)] = (entries, vertices + n)
+
+        for ((x, y), (entries, vertices)) in tiles.items():
+            path = os.path.join(directory, str(z), str(x))
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            fh = open_output(os.path.join(path, '%d.json' % y))
+            dump({'habitats': entries}, fh, compact=True)
+            fh.close()
+        print 'zoom', z, 'tiles', len(tiles), 'full', len(full)
+
+    fh = open_output(os.path.join(directory, 'index.json'))
+    dump({
+        'zooms': tile_zooms,
+        'bounds': [min_lon, min_lat, max_lon, max_lat],
+        'transports': transports
+    }, fh, compact=True)
+    fh.close()
+
+def open_output(path):
+    if compress:
+        return gzip.open(path, 'wb')
+    return open(path, 'wb')
+
 if len(sys.argv) < 2:
-    print 'output-habitats <destination>'
+    print 'output-habitats <destination> [groups] [compact] [gzip] [tiles]'
     sys.exit(1)
 
 destination = sys.argv[1]
+# link each habitat to its connected group rather than its neighbours
+groups = 'groups' in sys.argv[2:]
+# quantized, delta encoded points and no whitespace
+compact = 'compact' in sys.argv[2:]
+# write the file gzip compressed, for serving with Content-Encoding: gzip
+compress = 'gzip' in sys.argv[2:]
+# write a tile pyramid of every habitat into the destination directory
+tiles = 'tiles' in sys.argv[2:]
 
 conn = psycopg2.connect("dbname=gis")
 cur = conn.cursor()
 
-cur.execute("SELECT link_id, polygon_id FROM habitat_link")
+if groups:
+    cur.execute("SELECT group_id, polygon_id FROM habitat_group")
+else:
+    cur.execute("SELECT link_id, polygon_id FROM habitat_link")
 results = cur.fetchall()
 transports = []
 _links = {}
@@ -46,41 +202,40 @@ for link_id in _links.keys():
         'type': 'land'
     })
 
-results = []
-for h_type in limits.keys():
-    if limits[h_type] > 0:
-        cur.execute("SELECT polygon_id, h_type, ST_AsText(geom) FROM habitat WHERE h_type = %s ORDER BY ST_Area(ST_Transform(geom, 27700)) DESC LIMIT %s;", (h_type, limits[h_type]))
-        results.extend(cur.fetchall())
+if tiles:
+    write_tiles(conn, destination, links, transports)
+    conn.close()
+    sys.exit(0)
+
+fh = open_output(destination)
+fh.write("ESD.modelDescriptor['transports'] = ")
+dump(transports, fh, compact)
+fh.write(";\n")
 
-habitats = []
-for (_id, _type, geom) in results:
+# habitats are written as they are read
+fh.write("ESD.modelDescriptor['habitats'] = [")
+n = 0
+for (_id, _type, geom) in habitat_rows(conn):
     print _id, _type
-    shape = shapely.wkt.loads(geom)
-    points = []
-    for (x, y) in shape.exterior.coords:
-        points.append(float("%.6f" % x))
-        points.append(float("%.6f" % y))
+    shape = wkb_geom(geom)
 
     if _id in links:
         _links = map(str, links[_id])
     else:
         _links = []
 
-    habitats.append({
+    fh.write(",\n" if n > 0 else "\n")
+    dump({
         'id': str(_id),
         'type': type_map[_type],
-        'points': points[0:-2],
+        'points': habitat_points(shape, compact),
         'regulation': [],
         'links': _links
-    })
+    }, fh, compact)
+    n += 1
+fh.write("\n];\n")
+if compact:
+    fh.write(decoder)
+fh.close()
 
 conn.close()
-
-fh = open(destination, 'wb')
-fh.write("ESD.modelDescriptor['transports'] = ")
-json.dump(transports, fh, sort_keys=True, indent=2)
-fh.write(";\n")
-fh.write("ESD.modelDescriptor['habitats'] = ")
-json.dump(habitats, fh, sort_keys=True, indent=2)
-fh.write(";\n")
-fh.close()
@@ -3,10 +3,21 @@
 #include <stdint.h>
 #include <string.h>
 #include <assert.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+
+#define RASTER_MAGIC        "habitats-raster 1\n"
+#define RASTER_HEADER_SIZE  4096
+#define POLYGON_MAGIC       "HABPOLY1"
 
 static unsigned int base_x, base_y, base_width, base_height, step, points;
 static uint8_t *route_map = NULL;
 static uint8_t *type_map = NULL;
+static uint8_t *raster_map = NULL;
+static size_t raster_size = 0;
+static FILE *polygon_out = NULL;
 
 enum {
     D_NW = 0,
@@ -128,7 +139,7 @@ static void load_data(FILE *fh)
 
     points = 0;
     parse_header(header);
-    fprintf(stdout,
+    fprintf(stderr,
         "base_x = %d, base_y = %d, base_width = %d, step = %d, points = %d\n",
         base_x, base_y, base_width, step, points
     );
@@ -151,6 +162,68 @@ static void load_data(FILE *fh)
     }
 }
 
+static int load_raster(const char *path)
+{
+    char header[RASTER_HEADER_SIZE + 1];
+    char *line, *save = NULL;
+    int layer = -1;
+    struct stat st;
+    int fd, ret;
+
+    fd = open(path, O_RDONLY);
+    if (fd < 0)
+        return 0;
+
+    memset(header, 0, sizeof(header));
+    ret = read(fd, header, RASTER_HEADER_SIZE);
+    if (ret != RASTER_HEADER_SIZE || strncmp(header, RASTER_MAGIC, strlen(RASTER_MAGIC))) {
+        close(fd);
+        return 0;
+    }
+
+    for (line = strtok_r(header, "\n", &save); line; line = strtok_r(NULL, "\n", &save)) {
+        unsigned int v;
+        if (sscanf(line, "step %u", &v) == 1) step = v;
+        else if (sscanf(line, "base_x %u", &v) == 1) base_x = v;
+        else if (sscanf(line, "base_y %u", &v) == 1) base_y = v;
+        else if (sscanf(line, "width %u", &v) == 1) base_width = v;
+        else if (sscanf(line, "height %u", &v) == 1) base_height = v;
+        else if (!strncmp(line, "layers ", 7)) {
+            char *name, *lsave = NULL;
+            int i = 0;
+            for (name = strtok_r(line + 7, " ", &lsave); name; name = strtok_r(NULL, " ", &lsave), ++i) {
+                if (!strcmp(name, "type"))
+                    layer = i;
+            }
+        }
+    }
+    points = base_width * base_height;
+
+    fprintf(stderr,
+        "base_x = %d, base_y = %d, base_width = %d, step = %d, points = %d\n",
+        base_x, base_y, base_width, step, points
+    );
+
+    if (layer < 0 || !points || fstat(fd, &st)
+            || st.st_size < RASTER_HEADER_SIZE + ((off_t) layer + 1) * points) {
+        fprintf(stderr, "raster has no type layer\n");
+        close(fd);
+        return 1;
+    }
+
+    // map the type layer in place rather than reading a copy
+    raster_size = st.st_size;
+    raster_map = mmap(NULL, raster_size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if (raster_map == MAP_FAILED) {
+        fprintf(stderr, "unable to map raster\n");
+        raster_map = NULL;
+        return 1;
+    }
+    type_map = raster_map + RASTER_HEADER_SIZE + ((size_t) layer * points);
+
+    return 1;
+}
 
 static uint8_t type_map_point(const int x, const int y)
 {
@@ -171,6 +244,41 @@ static void set_route_map_point(const int x, const int y, const uint8_t v)
     route_map[(y * base_width) + x] = v;
 }
 
+// binary polygon stream: the magic and step, then for each polygon its
+// id, type and point count followed by the points as x, y pairs; all
+// values are native (little endian) int32
+static int open_polygons(const char *path)
+{
+    int32_t header = step;
+
+    polygon_out = fopen(path, "wb");
+    if (!polygon_out)
+        return 0;
+    fwrite(POLYGON_MAGIC, strlen(POLYGON_MAGIC), 1, polygon_out);
+    fwrite(&header, sizeof(header), 1, polygon_out);
+    return 1;
+}
+
+static void write_polygon(unsigned int id, uint8_t type, stack_t *found)
+{
+    int32_t record[3];
+    int32_t *xy;
+    int i;
+
+    record[0] = id;
+    record[1] = type;
+    record[2] = found->n;
+    fwrite(record, sizeof(record), 1, polygon_out);
+
+    xy = (int32_t *) malloc(sizeof(int32_t) * 2 * found->n);
+    for (i = 0; i < found->n; ++i) {
+        xy[(i * 2) + 0] = (found->points[i].x + base_x) * step;
+        xy[(i * 2) + 1] = (found->points[i].y + base_y) * step;
+    }
+    fwrite(xy, sizeof(int32_t) * 2, found->n, polygon_out);
+    free(xy);
+}
+
 static unsigned int start_route(unsigned int id, int start_x, int start_y)
 {
     unsigned int n_routed;
@@ -219,13 +327,17 @@ static unsigned int start_route(unsigned int id, int start_x, int start_y)
     } while(ret >= 0);
 
     // output this polygon
-    fprintf(stdout, "polygon %u (type = %d) (points = %d): ", id, type, found.n); 
-    for (i = 0; i < found.n; ++i) {
-        fprintf(stdout, "%d,%d ", 
-            (found.points[i].x + base_x) * step, 
-            (found.points[i].y + base_y) * step);
+    if (polygon_out) {
+        write_polygon(id, type, &found);
+    } else {
+        fprintf(stdout, "polygon %u (type = %d) (points = %d): ", id, type, found.n); 
+        for (i = 0; i < found.n; ++i) {
+            fprintf(stdout, "%d,%d ", 
+                (found.points[i].x + base_x) * step, 
+                (found.points[i].y + base_y) * step);
+        }
+        fprintf(stdout, "\n");
     }
-    fprintf(stdout, "\n");
    
     // clean up and prepare for return
     n_routed = found.n;
@@ -307,20 +419,34 @@ int main(int argc, char *argv[])
     FILE *fh;
 
     if (argc < 2) {
-        fprintf(stderr, "route <file>\n");
+        fprintf(stderr, "route <file> [<polygons>]\n");
         return 1;
     }
 
-    fh = fopen(argv[1], "rb");
-    load_data(fh);
-    fclose(fh);
+    if (!load_raster(argv[1])) {
+        fh = fopen(argv[1], "rb");
+        if (!fh) {
+            fprintf(stderr, "unable to open %s\n", argv[1]);
+            return 2;
+        }
+        load_data(fh);
+        fclose(fh);
+    }
 
     if (!type_map) {
         return 2;
     }
 
+    if (argc > 2 && !open_polygons(argv[2])) {
+        fprintf(stderr, "unable to open %s\n", argv[2]);
+        return 2;
+    }
+
     build_route_map();
     process_map();
 
+    if (polygon_out)
+        fclose(polygon_out);
+
     return 0;
 }
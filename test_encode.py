@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+
+import unittest
+import math
+import numpy
+
+from shapely.geometry import Polygon
+
+from habitats import *
+
+def decode(points):
+    # what the decoder in output-habitats.py does once the file has loaded
+    xs = numpy.cumsum(points[0::2])
+    ys = numpy.cumsum(points[1::2])
+    return (xs, ys)
+
+def ring(n, lon, lat, radius):
+    # a ring of n points around lon, lat, west of Greenwich so longitudes
+    # are negative
+    return Polygon([(lon + (math.cos(2 * math.pi * k / n) * radius), lat + (math.sin(2 * math.pi * k / n) * radius)) for k in range(n)])
+
+class EncodeTest(unittest.TestCase):
+    def test_plain(self):
+        shape = Polygon([(-1.2345678, 54.1234564), (-1.2, 54.1), (-1.3, 54.2)])
+        self.assertEqual(habitat_points(shape), [-1.234568, 54.123456, -1.2, 54.1, -1.3, 54.2])
+
+    def test_compact_deltas(self):
+        shape = Polygon([(-1.0, 54.0), (-1.000001, 54.000002), (-0.999999, 54.000003)])
+        self.assertEqual(habitat_points(shape, compact=True), [-1000000, 54000000, -1, 2, 2, 1])
+
+    def test_round_trip(self):
+        # decoding gives back the plain coordinates, with no drift however
+        # long the ring, as every delta is a whole number of quanta
+        for n in (3, 10, 1000, 20000):
+            shape = ring(n, -1.23456789, 54.3210987, 0.05)
+            points = habitat_points(shape, compact=True)
+            self.assertTrue(all(isinstance(v, (int, long)) for v in points))
+            (xs, ys) = decode(points)
+            coords = numpy.array(shape.exterior.coords)[:-1]
+            self.assertTrue((xs == numpy.rint(coords[:, 0] * quantum)).all())
+            self.assertTrue((ys == numpy.rint(coords[:, 1] * quantum)).all())
+            plain = habitat_points(shape)
+            self.assertTrue(numpy.abs((xs / float(quantum)) - plain[0::2]).max() < 1e-9)
+            self.assertTrue(numpy.abs((ys / float(quantum)) - plain[1::2]).max() < 1e-9)
+
+if __name__ == '__main__':
+    unittest.main()
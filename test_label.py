@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+import scipy.ndimage
+
+from habitats import *
+
+def random_types(rnd, shape, values, p):
+    # RandomState.choice needs numpy 1.7
+    return numpy.array(values, dtype=numpy.uint8)[numpy.searchsorted(numpy.cumsum(p), rnd.random_sample(shape) * sum(p))]
+
+def label_grid(types, tile):
+    labels = numpy.zeros(types.shape, dtype=numpy.uint32)
+    n_labels = label_types(types, labels, tile)
+    parent = stitch(types, labels, n_labels, tile)
+    components = relabel(types, labels, parent, tile)
+    return (labels, components)
+
+class LabelTest(unittest.TestCase):
+    def check(self, types, tile):
+        (labels, components) = label_grid(types, tile)
+        self.assertTrue(((labels == 0) == (types == 0)).all())
+
+        # the same partition as labelling the whole grid, type by type
+        n = 0
+        for t in numpy.unique(types):
+            if t == 0:
+                continue
+            (found, k) = scipy.ndimage.label(types == t, structure=numpy.ones((3, 3)))
+            for c in range(1, k + 1):
+                ids = numpy.unique(labels[found == c])
+                self.assertEqual(len(ids), 1)
+                self.assertEqual(numpy.count_nonzero(labels == ids[0]), numpy.count_nonzero(found == c))
+            n += k
+        self.assertEqual(len(components), n)
+
+        # types, sizes and bounding boxes of the numbered components
+        for (c_id, c_type, c_count, c_min_x, c_min_y, c_max_x, c_max_y) in components:
+            (ys, xs) = numpy.nonzero(labels == c_id)
+            self.assertEqual(c_count, len(xs))
+            self.assertTrue((types[ys, xs] == c_type).all())
+            self.assertEqual((c_min_x, c_min_y, c_max_x, c_max_y), (xs.min(), ys.min(), xs.max(), ys.max()))
+
+    def test_single_tile(self):
+        rnd = numpy.random.RandomState(1)
+        self.check(random_types(rnd, (20, 30), [0, 10, 20], [1, 1, 1]), 64)
+
+    def test_diagonal_seam(self):
+        # components joined only by diagonal steps across the seams, at and
+        # beside the corner where four tiles meet
+        types = numpy.zeros((8, 8), dtype=numpy.uint8)
+        for k in range(8):
+            types[k, k] = 20
+            types[k, 7 - k] = 10
+        self.check(types, 4)
+        self.check(types, 3)
+
+    def test_spiral(self):
+        # one component winding back across the same seams many times
+        types = numpy.zeros((21, 21), dtype=numpy.uint8)
+        (lo, hi) = (0, 20)
+        while lo < hi:
+            types[lo, lo:hi + 1] = 20
+            types[lo:hi + 1, hi] = 20
+            types[hi, lo:hi + 1] = 20
+            types[lo + 2:hi + 1, lo] = 20
+            if lo + 2 <= hi:
+                types[lo + 2, lo:lo + 3] = 20
+            (lo, hi) = (lo + 2, hi - 2)
+        self.check(types, 4)
+
+    def test_random(self):
+        rnd = numpy.random.RandomState(2)
+        for tile in (1, 2, 3, 5, 8):
+            for k in range(10):
+                types = random_types(rnd, (rnd.randint(1, 25), rnd.randint(1, 25)), [0, 10, 20, 30], [0.4, 0.2, 0.2, 0.2])
+                self.check(types, tile)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+import unittest
+import random
+import math
+import numpy
+
+from shapely.geometry import Point, Polygon, MultiPolygon, box
+
+from habitats import *
+
+def reference(geom, x0, y0, n_x, n_y, step):
+    # point by point containment, as the grid was sampled before
+    mask = numpy.zeros((n_y, n_x), dtype=numpy.bool_)
+    for j in range(n_y):
+        for i in range(n_x):
+            mask[j, i] = geom.contains(Point(x0 + (i * step), y0 + (j * step)))
+    return mask
+
+def random_polygon(rnd, cx, cy, radius, n):
+    # star shaped around its centre, so always simple
+    angles = sorted(rnd.uniform(0, 2 * math.pi) for k in range(n))
+    return Polygon([(cx + (math.cos(a) * rnd.uniform(0.2, 1.0) * radius),
+        cy + (math.sin(a) * rnd.uniform(0.2, 1.0) * radius)) for a in angles])
+
+class RasterizeTest(unittest.TestCase):
+    # grid points sit half way between the integer coordinates used by the
+    # shapes, so none lies on an edge
+    grid = (0.5, 0.5, 24, 20, 1.0)
+
+    def check(self, geom):
+        (values, counts) = rasterize([(geom, 7)], *self.grid)
+        mask = reference(geom, *self.grid)
+        self.assertTrue((counts == mask).all())
+        self.assertTrue((values == (mask * 7)).all())
+
+    def test_box(self):
+        self.check(box(2, 3, 10, 15))
+
+    def test_hole(self):
+        self.check(Polygon([(1, 1), (20, 1), (20, 18), (1, 18)], [[(5, 5), (12, 5), (12, 12), (5, 12)]]))
+
+    def test_multipolygon(self):
+        self.check(MultiPolygon([box(1, 1, 6, 6), box(8, 2, 23, 7), box(3, 10, 9, 19)]))
+
+    def test_clipped(self):
+        # shapes running off the tile are cut at its edges
+        self.check(box(-10, -5, 40, 4))
+        self.check(box(-10, -10, -2, -2))
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for k in range(100):
+            self.check(random_polygon(rnd, rnd.uniform(0, 24), rnd.uniform(0, 20), rnd.uniform(2, 15), rnd.randint(3, 20)))
+
+    def test_overlap(self):
+        # every shape is counted; the value is that of the last shape
+        (values, counts) = rasterize([(box(0, 0, 10, 10), 1), (box(5, 5, 15, 15), 2)], *self.grid)
+        self.assertEqual(counts[7, 7], 2)
+        self.assertEqual(values[7, 7], 2)
+        self.assertEqual(counts[2, 2], 1)
+        self.assertEqual(values[2, 2], 1)
+        self.assertEqual(counts[12, 12], 1)
+        self.assertEqual(values[12, 12], 2)
+        self.assertEqual(counts[18, 2], 0)
+
+if __name__ == '__main__':
+    unittest.main()
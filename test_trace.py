@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+import scipy.ndimage
+
+from shapely.geometry import box
+from shapely.ops import cascaded_union
+
+from habitats import *
+
+step = 10.0
+buffer = 10.0
+
+def reference(xs, ys):
+    # the union of the point squares, as build-polygons once computed it
+    return cascaded_union([box(x - buffer, y - buffer, x + buffer, y + buffer) for (x, y) in zip(xs, ys)])
+
+def components(rnd, size, density):
+    # the 8-connected components of a random grid, as route finds them
+    cells = rnd.random_sample((size, size)) < density
+    (labels, n) = scipy.ndimage.label(cells, structure=numpy.ones((3, 3)))
+    for k in range(1, n + 1):
+        (ys, xs) = numpy.nonzero(labels == k)
+        yield ((xs * step) + 1000.0, (ys * step) + 2000.0)
+
+class TraceTest(unittest.TestCase):
+    def check(self, xs, ys):
+        polygon = trace_polygon(numpy.asarray(xs, dtype=numpy.float64), numpy.asarray(ys, dtype=numpy.float64), step, buffer)
+        expected = reference(xs, ys)
+        self.assertTrue(polygon.is_valid)
+        self.assertEqual(polygon.geom_type, 'Polygon')
+        self.assertAlmostEqual(polygon.area, expected.area, places=6)
+        self.assertAlmostEqual(polygon.symmetric_difference(expected).area, 0.0, places=6)
+        self.assertEqual(len(polygon.interiors), len(getattr(expected, 'interiors', [])))
+
+    def test_point(self):
+        self.check([0.0], [0.0])
+
+    def test_line(self):
+        self.check([0.0, 10.0, 20.0, 30.0], [0.0, 0.0, 0.0, 0.0])
+
+    def test_diagonal(self):
+        self.check([0.0, 10.0, 20.0], [0.0, 10.0, 20.0])
+
+    def test_hole(self):
+        # a ring of points two cells wide around an empty middle
+        xs = []
+        ys = []
+        for i in range(8):
+            for j in range(8):
+                if i in (0, 7) or j in (0, 7):
+                    xs.append(i * step)
+                    ys.append(j * step)
+        self.check(xs, ys)
+
+    def test_pinched_hole(self):
+        # the squares around these points leave a hole whose corner touches
+        # the outline, so the traced ring meets itself at that vertex
+        xs = [4, 4, 5, 3, 6, 6, 5, 6, 6, 6]
+        ys = [0, 1, 1, 2, 2, 3, 4, 4, 5, 6]
+        self.check([x * step for x in xs], [y * step for y in ys])
+
+    def test_random(self):
+        rnd = numpy.random.RandomState(1)
+        n = 0
+        for k in range(20):
+            for density in (0.3, 0.45, 0.6):
+                for (xs, ys) in components(rnd, 16, density):
+                    self.check(xs, ys)
+                    n += 1
+        self.assertTrue(n > 300)
+
+    def test_split_ring(self):
+        # a figure of eight through (1, 1) becomes two loops
+        ring = [(0, 0), (1, 0), (1, 1), (2, 1), (2, 2), (1, 2), (1, 1), (0, 1)]
+        loops = split_ring(ring)
+        self.assertEqual(sorted(map(len, loops)), [4, 4])
+        self.assertEqual(sorted(map(sorted, loops)), sorted(map(sorted, [[(0, 0), (1, 0), (1, 1), (0, 1)], [(1, 1), (2, 1), (2, 2), (1, 2)]])))
+
+if __name__ == '__main__':
+    unittest.main()
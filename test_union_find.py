@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import unittest
+import numpy
+
+from habitats import *
+
+def reference_sets(n, a, b):
+    # connected components by walking an adjacency list
+    neighbours = [[] for k in range(n)]
+    for (x, y) in zip(a, b):
+        neighbours[x].append(y)
+        neighbours[y].append(x)
+    root = [None] * n
+    for k in range(n):
+        if root[k] is not None:
+            continue
+        stack = [k]
+        root[k] = k
+        while stack:
+            for y in neighbours[stack.pop()]:
+                if root[y] is None:
+                    root[y] = k
+                    stack.append(y)
+    return root
+
+class UnionFindTest(unittest.TestCase):
+    def test_no_pairs(self):
+        parent = uf_union(uf_create(5), [], [])
+        self.assertEqual(parent.tolist(), [0, 1, 2, 3, 4])
+
+    def test_chain(self):
+        # a chain joined from its far end, each set rooted at its smallest
+        parent = uf_union(uf_create(6), [5, 4, 3, 2], [4, 3, 2, 1])
+        self.assertEqual(parent.tolist(), [0, 1, 1, 1, 1, 1])
+
+    def test_repeated(self):
+        # pairs may repeat, point both ways and join a set to itself
+        parent = uf_union(uf_create(4), [0, 1, 1, 3, 3], [1, 0, 1, 2, 2])
+        self.assertEqual(parent.tolist(), [0, 0, 2, 2])
+
+    def test_incremental(self):
+        # unions applied in several calls give the same sets
+        parent = uf_create(6)
+        uf_union(parent, [4], [5])
+        uf_union(parent, [2], [3])
+        uf_union(parent, [3, 0], [5, 1])
+        self.assertEqual(parent.tolist(), [0, 0, 2, 2, 2, 2])
+
+    def test_random(self):
+        rnd = numpy.random.RandomState(1)
+        for k in range(50):
+            n = rnd.randint(1, 200)
+            m = rnd.randint(0, 2 * n)
+            a = rnd.randint(0, n, m)
+            b = rnd.randint(0, n, m)
+            parent = uf_union(uf_create(n), a, b)
+            root = reference_sets(n, a.tolist(), b.tolist())
+            # the same partition, rooted at the smallest member
+            self.assertEqual(parent.tolist(), root)
+            self.assertTrue((parent[parent] == parent).all())
+
+class MergeClustersTest(unittest.TestCase):
+    def test_clusters(self):
+        ids = numpy.array([40, 10, 30, 20, 50, 60], dtype=numpy.int64)
+        areas = numpy.array([1.0, 5.0, 3.0, 4.0, 2.0, 6.0])
+        (members, clusters) = merge_clusters(ids, areas, [10, 30, 50], [20, 40, 40])
+        clusters = sorted([ids[c].tolist() for c in clusters])
+        # each group largest first; 60 has no candidates
+        self.assertEqual(clusters, [[10, 20], [30, 50, 40]])
+        self.assertEqual(sorted(ids[members].tolist()), [10, 20, 30, 40, 50])
+
+    def test_empty(self):
+        ids = numpy.array([1, 2], dtype=numpy.int64)
+        (members, clusters) = merge_clusters(ids, numpy.array([1.0, 2.0]), [], [])
+        self.assertEqual(len(members), 0)
+        self.assertEqual(clusters, [])
+
+class LinkGroupsTest(unittest.TestCase):
+    def test_groups(self):
+        # sparse polygon ids, a chain of links and an unlinked polygon
+        rows = link_groups([105, 7, 42, 300, 12], [(42, 105), (7, 42), (12, 300)])
+        self.assertEqual(sorted(rows), [(7, 7), (7, 42), (7, 105), (12, 12), (12, 300)])
+
+    def test_none(self):
+        self.assertEqual(link_groups([3, 1, 2], []), [])
+
+    def test_random(self):
+        rnd = numpy.random.RandomState(2)
+        polygon_ids = sorted(set(rnd.randint(1, 100000, 300).tolist()))
+        n = len(polygon_ids)
+        a = rnd.randint(0, n, 200)
+        b = rnd.randint(0, n, 200)
+        pairs = [(polygon_ids[x], polygon_ids[y]) for (x, y) in zip(a, b) if x != y]
+        root = reference_sets(n, [polygon_ids.index(p[0]) for p in pairs], [polygon_ids.index(p[1]) for p in pairs])
+        sizes = dict((r, root.count(r)) for r in root)
+        expected = [(polygon_ids[root[k]], polygon_ids[k]) for k in range(n) if sizes[root[k]] > 1]
+        self.assertEqual(sorted(link_groups(polygon_ids, pairs)), sorted(expected))
+
+if __name__ == '__main__':
+    unittest.main()
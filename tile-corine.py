@@ -1,110 +1,136 @@
 #!/usr/bin/env python
 
-import subprocess
-import pyproj
 import psycopg2
+import math
 import time
-import threading
 import os
 
-def grid_points(x, y, width, height, step):
-    grid = []
-    for xi in range(int(width / step)):
-        for yi in range(int(height / step)):
-            grid.append(((x + (xi * step)), (y + (yi * step))))
-    return grid
-
-def osgb36_to_wgs84(coord):
-    osgb36 = pyproj.Proj(init='epsg:27700')
-    wgs84 = pyproj.Proj(init='epsg:4326')
-    if not isinstance(coord, list):
-        (easting, northing) = coord
-        lon, lat = pyproj.transform(osgb36, wgs84, easting, northing)
-        return (lon, lat)
-    else:
-        r = []
-        for (easting, northing) in coord:
-            lon, lat = pyproj.transform(osgb36, wgs84, easting, northing)
-            r.append((lon, lat))
-        return r
-
-def osgb36_to_etrs89(coord):
-    osgb36 = pyproj.Proj(init='epsg:27700')
-    etrs89 = pyproj.Proj(init='epsg:3035')
-    if not isinstance(coord, list):
-        (easting, northing) = coord
-        e, n = pyproj.transform(osgb36, etrs89, easting, northing)
-        return (e, n)
-    else:
-        r = []
-        for (easting, northing) in coord:
-            e, n = pyproj.transform(osgb36, etrs89, easting, northing)
-            r.append((e, n))
-        return r
-
-def process_points(label, coords):
+from shapely.geometry import MultiPolygon, box
+
+from habitats import *
+from config import *
+
+# tiles start at root_size and are split into quarters, down to min_size,
+# while the Corine polygons clipped to them hold more than max_vertices
+root_size = 10000.0 # m
+min_size = 1250.0 # m
+max_vertices = 20000
+# margin around the area of interest
+aoi_margin = 5000.0 # m
+n_workers = os.sysconf(os.sysconf_names['SC_NPROCESSORS_ONLN'])
+
+# tiles already cut, as (x, y, size), and roots whose leaves are all cut,
+# loaded once before the workers start
+done = set()
+
+def root_tiles(bounds):
+    (x0, y0, x1, y1) = bounds
+    for xi in range(int(math.floor(x0 / root_size)), int(math.ceil(x1 / root_size))):
+        for yi in range(int(math.floor(y0 / root_size)), int(math.ceil(y1 / root_size))):
+            yield (xi * root_size, yi * root_size, root_size)
+
+def piece_vertices(pieces):
+    n = 0
+    for (_id, code, name, parts) in pieces:
+        for polygon in parts:
+            n += len(polygon.exterior.coords) + sum([len(ring.coords) for ring in polygon.interiors])
+    return n
+
+def clip_root(cur, x, y, size):
+    # the Corine polygons touching a root tile, clipped to it by PostGIS;
+    # smaller tiles are cut from these pieces rather than from clc06
+    cur.execute("SELECT id, code, name, " + wkb_column("ST_Intersection(geom, b)") + " FROM clc06, (SELECT ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s), ST_Point(%s,%s)),3035) AS b) AS t WHERE ST_Intersects(geom, b)",
+        (x, y, x + size, y + size))
+    pieces = []
+    for (_id, code, name, wkb) in cur.fetchall():
+        parts = polygon_parts(wkb_geom(wkb))
+        if parts:
+            pieces.append((_id, code, name, parts))
+    return pieces
+
+def clip_pieces(pieces, x, y, size):
+    tile = box(x, y, x + size, y + size)
+    clipped = []
+    for (_id, code, name, parts) in pieces:
+        inside = []
+        for g in parts:
+            if tile.contains(g):
+                inside.append(g)
+            elif g.intersects(tile):
+                inside.extend(polygon_parts(g.intersection(tile)))
+        if inside:
+            clipped.append((_id, code, name, inside))
+    return clipped
+
+def split_tile(pieces, x, y, size):
+    # (x, y, size, pieces) leaves, splitting into quarters while the
+    # clipped pieces hold more than max_vertices
+    vertices = piece_vertices(pieces)
+    if (vertices <= max_vertices) or (size <= min_size):
+        yield (x, y, size, pieces, vertices)
+        return
+    half = size / 2.0
+    for (cx, cy) in [(x, y), (x + half, y), (x, y + half), (x + half, y + half)]:
+        for leaf in split_tile(clip_pieces(pieces, cx, cy, half), cx, cy, half):
+            yield leaf
+
+def mark_tile(cur, x, y, size):
+    cur.execute("INSERT INTO clc_tiling (x,y,size) VALUES(%s,%s,%s)", (x, y, size))
+
+def cut_tile(cur, x, y, size, pieces):
+    rows = [(_id, code, name, ewkb_hex(MultiPolygon(parts).wkb, 3035)) for (_id, code, name, parts) in pieces]
+    copy_rows(cur, 'clc_tiled', ['id', 'code', 'name', 'geom'], rows)
+    mark_tile(cur, x, y, size)
+    return len(rows)
+
+def process_tiles(label, results, tiles):
     conn = psycopg2.connect("dbname=gis")
     cur = conn.cursor()
 
-    n = 0
-    for (easting, northing) in coords:
-        (min_x, min_y) = (easting, northing)
-        (max_x, max_y) = (min_x + 10000.0, min_y + 10000.0)
-        n += 1
-        
-        print label, "%d/%d" % (n, len(coords))
-        print label, '@', easting, northing
-
-        cur.execute("SELECT x,y FROM clc_tiling WHERE x = %s AND y = %s", (min_x, min_y))
-        result = cur.fetchall()
-        if len(result) > 0:
-            print label, '@', easting, northing, 'skipped'
-        else:
+    for (x, y, size) in tiles:
+        if (x, y, size) in done:
+            print label, '@', x, y, size, 'skipped'
+            continue
+        # each root tile is clipped once and subdivided by the worker
+        # holding it
+        start = time.time()
+        pieces = clip_root(cur, x, y, size)
+        print label, '@', x, y, size, 'clipped = % 2.1fs, %d piece(s)' % (time.time() - start, len(pieces))
+        for (lx, ly, lsize, leaf, vertices) in split_tile(pieces, x, y, size):
+            if (lx, ly, lsize) in done:
+                print label, '@', lx, ly, lsize, 'skipped'
+                continue
             start = time.time()
-            cur.execute("INSERT INTO clc_tiled (id,code,name,geom) SELECT id,code,name,ST_Multi(ST_Intersection(geom, ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s), ST_point(%s,%s)),3035))) AS geom FROM clc06 WHERE ST_Intersects(geom, ST_SetSRID(ST_MakeBox2D(ST_Point(%s,%s), ST_Point(%s,%s)),3035))", (min_x, min_y, max_x, max_y, min_x, min_y, max_x, max_y))
-            count = cur.rowcount
-            cur.execute("INSERT INTO clc_tiling (x,y) VALUES(%s,%s)", (min_x, min_y))
+            count = cut_tile(cur, lx, ly, lsize, leaf)
             conn.commit()
             end = time.time()
-            print label, '@', easting, northing, 'elapsed = % 2.1fs, %d row(s)' % (end - start, count)
-    
+            print label, '@', lx, ly, lsize, 'elapsed = % 2.1fs, %d row(s), %d vertices' % (end - start, count, vertices)
+        if lsize != size:
+            # a split root is recorded once all its leaves are in, so a
+            # resumed run skips it without clipping it again
+            mark_tile(cur, x, y, size)
+            conn.commit()
+
     cur.close()
     conn.close()
 
-def divid_work(source, n_workers):
-    work = []
-    for i in range(n_workers):
-        work.append([])
-    n = 0
-    for item in source:
-        work[n].append(item)
-        n = (n + 1) % n_workers
-    return work
-
-# parameters
-min_x = 3060000
-min_y = 3110000
-max_x = 3990000
-max_y = 4280000
-width = max_x - min_x
-height = max_y - min_y
-n_workers = os.sysconf(os.sysconf_names['SC_NPROCESSORS_ONLN'])
-
 # bootstrap
-points = grid_points(min_x, min_y, width, height, 10000.0)
-work = divid_work(points, n_workers)
+bounds = osgb36_box_to_etrs89(min_x - aoi_margin, min_y - aoi_margin, max_x + aoi_margin, max_y + aoi_margin)
+roots = list(root_tiles(bounds))
 
-print "points    = ", len(points)
-print "n_workers = ", n_workers
+conn = psycopg2.connect("dbname=gis")
+cur = conn.cursor()
+cur.execute("SELECT x, y, size FROM clc_tiling")
+for (x, y, size) in cur.fetchall():
+    done.add((x, y, size))
+cur.close()
+conn.close()
 
-threads = []
-for i in range(n_workers):
-    label = "worker %d" % (i + 1)
-    thread = threading.Thread(target=process_points, args=(label,work[i]))
-    thread.start()
-    threads.append(thread)
+print "bounds    = ", bounds
+print "roots     = ", len(roots)
+print "done      = ", len(done)
+print "n_workers = ", n_workers
 
-for thread in threads:
-    thread.join()
+do_stream_par(roots, n_workers, process_tiles)
 
 print 'done'